@@ -0,0 +1,156 @@
+import os
+import csv
+import json
+import time
+import traceback
+from argparse import ArgumentParser
+
+from utils.main import SadTalker
+from utils.model_registry import preprocess_family
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ["1", "true", "yes", "y"]
+
+
+def parse_enhancer(value):
+    # SadTalker.test only supports gfpgan, a boolean-like flag selects it too
+    if value is None or str(value).strip() == "":
+        return None
+    if str(value).strip().lower() == "gfpgan" or parse_bool(value):
+        return "gfpgan"
+    return None
+
+
+def load_manifest(manifest_path):
+    """
+    Reads a CSV (with header) or JSONL manifest. Every row needs `source` and
+    `audio`; pose_style, preprocess, size, enhancer, still, batch_size and
+    expression_scale are optional.
+    """
+    with open(manifest_path, newline="", encoding="utf-8") as f:
+        if manifest_path.lower().endswith((".jsonl", ".json")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    jobs = []
+    for idx, row in enumerate(rows):
+        jobs.append(
+            {
+                "index": idx,
+                "source": row["source"],
+                "audio": row["audio"],
+                "pose_style": int(row.get("pose_style") or 0),
+                "preprocess": row.get("preprocess") or "crop",
+                "size": int(row.get("size") or 256),
+                "enhancer": parse_enhancer(row.get("enhancer")),
+                "still": parse_bool(row.get("still") or False),
+                "batch_size": int(row.get("batch_size") or 0),
+                "expression_scale": float(row.get("expression_scale") or 1.0),
+            }
+        )
+    return jobs
+
+
+def main(args):
+    jobs = load_manifest(args.manifest)
+    # run jobs that share models back to back so the registry never swaps
+    # models in the middle of a group.
+    jobs.sort(key=lambda job: (job["size"], preprocess_family(job["preprocess"])))
+
+    os.makedirs(args.result_dir, exist_ok=True)
+    report_path = args.report or os.path.join(args.result_dir, "batch_report.jsonl")
+
+    sad_talker = SadTalker(
+        args.checkpoint_dir,
+        args.config_dir,
+        lazy_load=True,
+        max_cached_models=args.max_cached_models,
+        use_tmpfs=args.tmpfs,
+    )
+
+    start = time.time()
+    failed = 0
+    with open(report_path, "a", encoding="utf-8") as report:
+        for position, job in enumerate(jobs, 1):
+            # jobs run grouped by model, not in manifest order
+            print(
+                "[%d/%d] manifest row %d: %s + %s"
+                % (
+                    position,
+                    len(jobs),
+                    job["index"] + 1,
+                    job["source"],
+                    job["audio"],
+                )
+            )
+            record = dict(job)
+            job_start = time.time()
+            try:
+                result = sad_talker.test(
+                    job["source"],
+                    job["audio"],
+                    preprocess=job["preprocess"],
+                    still_mode=job["still"],
+                    use_enhancer=job["enhancer"] is not None,
+                    batch_size=job["batch_size"],
+                    size=job["size"],
+                    pose_style=job["pose_style"],
+                    exp_scale=job["expression_scale"],
+                    result_dir=args.result_dir,
+                )
+                record["status"] = "done"
+                record["job_id"] = result["job_id"]
+                record["output"] = result["video_path"]
+                record["timings"] = result["timings"]
+            except Exception as e:
+                failed += 1
+                record["status"] = "failed"
+                record["error"] = repr(e)
+                traceback.print_exc()
+            record["seconds"] = round(time.time() - job_start, 3)
+
+            report.write(json.dumps(record) + "\n")
+            report.flush()
+
+    print(
+        "%d jobs, %d failed, %.1fs in total. Report: %s"
+        % (len(jobs), failed, time.time() - start, report_path)
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--manifest",
+        required=True,
+        help="CSV or JSONL file with source, audio, pose_style, preprocess, size, enhancer",
+    )
+    parser.add_argument(
+        "--checkpoint_dir", default="./checkpoints", help="path to checkpoints"
+    )
+    parser.add_argument("--config_dir", default="./config", help="path to config")
+    parser.add_argument("--result_dir", default="./results", help="path to output")
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="per-job result and timing records (JSONL), defaults to <result_dir>/batch_report.jsonl",
+    )
+    parser.add_argument(
+        "--max_cached_models",
+        type=int,
+        default=2,
+        help="how many model sets (one per size) to keep resident",
+    )
+    parser.add_argument(
+        "--tmpfs",
+        action="store_true",
+        help="keep job scratch files in /dev/shm instead of the system temp dir",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
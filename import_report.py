@@ -0,0 +1,67 @@
+import sys
+import subprocess
+from collections import defaultdict
+from argparse import ArgumentParser
+
+
+def parse_importtime(stderr):
+    """
+    Parses the output of `python -X importtime`. Returns a list of
+    (module, self_us, cumulative_us) in import order.
+    """
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3:
+            continue
+        records.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return records
+
+
+def main(args):
+    command = [sys.executable, "-X", "importtime", "-c", "import %s" % args.module]
+    process = subprocess.run(command, capture_output=True, text=True)
+    if process.returncode != 0:
+        print(process.stderr.splitlines()[-1] if process.stderr else "import failed")
+    records = parse_importtime(process.stderr)
+    if not records:
+        print("no import timings were reported")
+        return
+
+    # self time summed per top-level package, i.e. what each dependency costs
+    packages = defaultdict(int)
+    for name, self_us, _ in records:
+        packages[name.split(".")[0]] += self_us
+    total = sum(packages.values())
+
+    print(
+        "import %s: %.3fs in total, %d modules"
+        % (args.module, total / 1e6, len(records))
+    )
+    print()
+    print("%-40s %10s %7s" % ("package", "seconds", "share"))
+    for package, us in sorted(packages.items(), key=lambda x: -x[1])[: args.top]:
+        print("%-40s %10.3f %6.1f%%" % (package, us / 1e6, 100.0 * us / total))
+
+    print()
+    print("%-60s %10s" % ("module (cumulative)", "seconds"))
+    for name, _, cumulative_us in sorted(records, key=lambda x: -x[2])[: args.top]:
+        print("%-60s %10.3f" % (name, cumulative_us / 1e6))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="cumulative import cost per module of a SadTalker entry point"
+    )
+    parser.add_argument(
+        "--module",
+        default="utils.main",
+        help="module to import, e.g. utils.main, utils.facerender.animate, app",
+    )
+    parser.add_argument("--top", type=int, default=25, help="rows per table")
+
+    args = parser.parse_args()
+
+    main(args)
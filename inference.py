@@ -5,12 +5,8 @@ from time import strftime
 import os, sys, time
 from argparse import ArgumentParser
 
-from utils.utils.preprocess import CropAndExtract
-from utils.test_audio2coeff import Audio2Coeff
-from utils.facerender.animate import AnimateFromCoeff
-from utils.generate_batch import get_data
-from utils.generate_facerender_batch import get_facerender_data
 from utils.utils.init_path import init_path
+from utils.utils.workspace import JobWorkspace
 
 
 def main(args):
@@ -18,9 +14,7 @@ def main(args):
 
     pic_path = args.source_image
     audio_path = args.driven_audio
-    save_dir = os.path.join(args.result_dir, strftime("%Y_%m_%d_%H.%M.%S"))
-    os.makedirs(save_dir, exist_ok=True)
-    pose_style = args.pose_style
+    pose_style = list(dict.fromkeys(args.pose_style))
     device = args.device
     batch_size = args.batch_size
     input_yaw_list = args.input_yaw
@@ -39,109 +33,158 @@ def main(args):
         args.preprocess,
     )
 
-    # init model
+    # init model, the heavy pipeline modules are imported here so that
+    # `--help` and argument errors return immediately
+    from utils.utils.preprocess import CropAndExtract
+    from utils.test_audio2coeff import Audio2Coeff
+    from utils.facerender.animate import AnimateFromCoeff
+
     preprocess_model = CropAndExtract(sadtalker_paths, device)
 
     audio_to_coeff = Audio2Coeff(sadtalker_paths, device)
 
-    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
-
-    # crop image and extract 3dmm from image
-    first_frame_dir = os.path.join(save_dir, "first_frame_dir")
-    os.makedirs(first_frame_dir, exist_ok=True)
-    print("3DMM Extraction for source image")
-    first_coeff_path, crop_pic_path, crop_info = preprocess_model.generate(
-        pic_path,
-        first_frame_dir,
-        args.preprocess,
-        source_image_flag=True,
-        pic_size=args.size,
+    animate_from_coeff = AnimateFromCoeff(
+        sadtalker_paths, device, verify_finalize=args.verify_finalize
     )
-    if first_coeff_path is None:
-        print("Can't get the coeffs of the input")
-        return
+    if sadtalker_paths["use_safetensor"]:
+        from utils.utils.safetensor_helper import release_safetensor_checkpoint
 
-    if ref_eyeblink is not None:
-        ref_eyeblink_videoname = os.path.splitext(os.path.split(ref_eyeblink)[-1])[0]
-        ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_videoname)
-        os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
-        print("3DMM Extraction for the reference video providing eye blinking")
-        ref_eyeblink_coeff_path, _, _ = preprocess_model.generate(
-            ref_eyeblink,
-            ref_eyeblink_frame_dir,
+        release_safetensor_checkpoint(sadtalker_paths["checkpoint"])
+
+    # intermediate files go to a private workspace that is removed however the
+    # run ends; --verbose keeps it in result_dir, next to the videos
+    os.makedirs(args.result_dir, exist_ok=True)
+    workspace = JobWorkspace(
+        args.result_dir if args.verbose else None,
+        use_tmpfs=args.tmpfs,
+        prefix=strftime("%Y_%m_%d_%H.%M.%S") + "_",
+    )
+    save_dir = workspace.path
+    video_base = os.path.join(args.result_dir, os.path.basename(save_dir))
+    try:
+        # crop image and extract 3dmm from image
+        first_frame_dir = os.path.join(save_dir, "first_frame_dir")
+        os.makedirs(first_frame_dir, exist_ok=True)
+        print("3DMM Extraction for source image")
+        first_coeff_path, crop_pic_path, crop_info = preprocess_model.generate(
+            pic_path,
+            first_frame_dir,
             args.preprocess,
-            source_image_flag=False,
+            source_image_flag=True,
+            pic_size=args.size,
         )
-    else:
-        ref_eyeblink_coeff_path = None
+        if first_coeff_path is None:
+            print("Can't get the coeffs of the input")
+            return
 
-    if ref_pose is not None:
-        if ref_pose == ref_eyeblink:
-            ref_pose_coeff_path = ref_eyeblink_coeff_path
-        else:
-            ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
-            ref_pose_frame_dir = os.path.join(save_dir, ref_pose_videoname)
-            os.makedirs(ref_pose_frame_dir, exist_ok=True)
-            print("3DMM Extraction for the reference video providing pose")
-            ref_pose_coeff_path, _, _ = preprocess_model.generate(
-                ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False
+        if ref_eyeblink is not None:
+            ref_eyeblink_videoname = os.path.splitext(
+                os.path.split(ref_eyeblink)[-1]
+            )[0]
+            ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_videoname)
+            os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
+            print("3DMM Extraction for the reference video providing eye blinking")
+            ref_eyeblink_coeff_path, _, _ = preprocess_model.generate(
+                ref_eyeblink,
+                ref_eyeblink_frame_dir,
+                args.preprocess,
+                source_image_flag=False,
             )
-    else:
-        ref_pose_coeff_path = None
+        else:
+            ref_eyeblink_coeff_path = None
 
-    # audio2ceoff
-    batch = get_data(
-        first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still
-    )
-    coeff_path = audio_to_coeff.generate(
-        batch, save_dir, pose_style, ref_pose_coeff_path
-    )
+        if ref_pose is not None:
+            if ref_pose == ref_eyeblink:
+                ref_pose_coeff_path = ref_eyeblink_coeff_path
+            else:
+                ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
+                ref_pose_frame_dir = os.path.join(save_dir, ref_pose_videoname)
+                os.makedirs(ref_pose_frame_dir, exist_ok=True)
+                print("3DMM Extraction for the reference video providing pose")
+                ref_pose_coeff_path, _, _ = preprocess_model.generate(
+                    ref_pose,
+                    ref_pose_frame_dir,
+                    args.preprocess,
+                    source_image_flag=False,
+                )
+        else:
+            ref_pose_coeff_path = None
 
-    # 3dface render
-    if args.face3dvis:
-        from utils.face3d.visualize import gen_composed_video
+        # audio2ceoff
+        from utils.generate_batch import get_data
 
-        gen_composed_video(
-            args,
-            device,
+        batch = get_data(
             first_coeff_path,
-            coeff_path,
             audio_path,
-            os.path.join(save_dir, "3dface.mp4"),
+            device,
+            ref_eyeblink_coeff_path,
+            still=args.still,
+        )
+        # several styles share one audio2exp pass and one batched pose decode
+        coeff_paths = audio_to_coeff.generate_styles(
+            batch,
+            save_dir,
+            pose_style,
+            ref_pose_coeff_path,
+            precision=args.precision,
+            silence_db=args.silence_db,
         )
 
-    # coeff2video
-    data = get_facerender_data(
-        coeff_path,
-        crop_pic_path,
-        first_coeff_path,
-        audio_path,
-        batch_size,
-        input_yaw_list,
-        input_pitch_list,
-        input_roll_list,
-        expression_scale=args.expression_scale,
-        still_mode=args.still,
-        preprocess=args.preprocess,
-        size=args.size,
-    )
+        from utils.generate_facerender_batch import get_facerender_data
 
-    result = animate_from_coeff.generate(
-        data,
-        save_dir,
-        pic_path,
-        crop_info,
-        enhancer=args.enhancer,
-        background_enhancer=args.background_enhancer,
-        preprocess=args.preprocess,
-        img_size=args.size,
-    )
+        for style, coeff_path in zip(pose_style, coeff_paths):
+            suffix = "" if len(pose_style) == 1 else "_style%d" % style
+
+            # 3dface render
+            if args.face3dvis:
+                from utils.face3d.visualize import gen_composed_video
 
-    shutil.move(result, save_dir + ".mp4")
-    print("The generated video is named:", save_dir + ".mp4")
+                gen_composed_video(
+                    args,
+                    device,
+                    first_coeff_path,
+                    coeff_path,
+                    audio_path,
+                    os.path.join(save_dir, "3dface%s.mp4" % suffix),
+                    temp_dir=save_dir,
+                )
 
-    if not args.verbose:
-        shutil.rmtree(save_dir)
+            # coeff2video
+            data = get_facerender_data(
+                coeff_path,
+                crop_pic_path,
+                first_coeff_path,
+                audio_path,
+                batch_size,
+                input_yaw_list,
+                input_pitch_list,
+                input_roll_list,
+                expression_scale=args.expression_scale,
+                still_mode=args.still,
+                preprocess=args.preprocess,
+                size=args.size,
+            )
+
+            result = animate_from_coeff.generate(
+                data,
+                save_dir,
+                pic_path,
+                crop_info,
+                enhancer=args.enhancer,
+                background_enhancer=args.background_enhancer,
+                preprocess=args.preprocess,
+                img_size=args.size,
+                segment_frames=args.segment_frames,
+                precision=args.precision,
+                temp_dir=save_dir,
+            )
+
+            shutil.move(result, video_base + suffix + ".mp4")
+            print("The generated video is named:", video_base + suffix + ".mp4")
+
+    finally:
+        if not args.verbose:
+            workspace.cleanup()
 
 
 if __name__ == "__main__":
@@ -169,10 +212,35 @@ if __name__ == "__main__":
     )
     parser.add_argument("--result_dir", default="./results", help="path to output")
     parser.add_argument(
-        "--pose_style", type=int, default=0, help="input pose style from [0, 46)"
+        "--pose_style",
+        nargs="+",
+        type=int,
+        default=[0],
+        help="input pose style from [0, 46), several render one video per style",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=0,
+        help="frames per facerender call, 0 picks it from free memory / a quick probe",
+    )
+    parser.add_argument(
+        "--segment_frames",
+        type=int,
+        default=0,
+        help="long audio: render and encode the video in segments of this many frames, 0 renders it in one piece",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="autocast precision of the audio models and the face renderer, fp16 needs CUDA; see precision_report.py",
     )
     parser.add_argument(
-        "--batch_size", type=int, default=2, help="the batch size of facerender"
+        "--silence_db",
+        type=float,
+        default=None,
+        help="mel windows at most this loud (dB, e.g. -60) are encoded as one silent span by the audio models",
     )
     parser.add_argument(
         "--size", type=int, default=256, help="the image size of the facerender"
@@ -234,6 +302,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--verbose", action="store_true", help="saving the intermedia output or not"
     )
+    parser.add_argument(
+        "--tmpfs",
+        action="store_true",
+        help="keep intermediate files in /dev/shm instead of the system temp dir",
+    )
+    parser.add_argument(
+        "--verify_finalize",
+        action="store_true",
+        help="check the inference-folded face renderer against the original modules",
+    )
     parser.add_argument(
         "--old_version",
         action="store_true",
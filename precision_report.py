@@ -0,0 +1,139 @@
+import copy
+import os
+import random
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from utils.utils.init_path import init_path
+from utils.utils.precision import PRECISIONS, psnr
+
+
+def main(args):
+    # heavy pipeline modules are imported here so that `--help` returns at once
+    from utils.utils.preprocess import CropAndExtract
+    from utils.test_audio2coeff import Audio2Coeff
+    from utils.facerender.animate import AnimateFromCoeff
+    from utils.generate_batch import get_data
+    from utils.generate_facerender_batch import get_facerender_data
+    from utils.utils.workspace import JobWorkspace
+    from utils.utils.safetensor_helper import release_safetensor_checkpoint
+
+    current_root_path = os.path.dirname(os.path.abspath(__file__))
+    paths = init_path(
+        args.checkpoint_dir,
+        os.path.join(current_root_path, "config"),
+        args.size,
+        False,
+        args.preprocess,
+    )
+    preprocess_model = CropAndExtract(paths, args.device)
+    audio_to_coeff = Audio2Coeff(paths, args.device)
+    animate_from_coeff = AnimateFromCoeff(paths, args.device)
+    if paths["use_safetensor"]:
+        release_safetensor_checkpoint(paths["checkpoint"])
+
+    with JobWorkspace() as workspace:
+        first_coeff_path, crop_pic_path, crop_info = preprocess_model.generate(
+            args.source_image,
+            workspace.subdir("first_frame_dir"),
+            args.preprocess,
+            source_image_flag=True,
+            pic_size=args.size,
+        )
+        if first_coeff_path is None:
+            raise AttributeError("No face is detected")
+
+        # get_data draws the blinks at random: build the batch once so every
+        # precision gets the same inputs, and the same pose CVAE noise below
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        batch = get_data(first_coeff_path, args.driven_audio, args.device, None)
+
+        def coefficients(precision):
+            return audio_to_coeff.generate(
+                copy.deepcopy(batch),
+                workspace.subdir(precision),
+                args.pose_style,
+                precision=precision,
+                seed=args.seed,
+            )
+
+        def frames(coeff_path, precision):
+            data = get_facerender_data(
+                coeff_path,
+                crop_pic_path,
+                first_coeff_path,
+                args.driven_audio,
+                args.batch_size,
+                preprocess=args.preprocess,
+                size=args.size,
+            )
+            end = min(args.frames, data["frame_num"])
+            start_time = time.time()
+            chunks = list(
+                animate_from_coeff.iter_frames(data, args.preprocess, 0, end, precision)
+            )
+            return np.concatenate(chunks), time.time() - start_time
+
+        reference_coeff = coefficients("fp32")
+        reference, reference_seconds = frames(reference_coeff, "fp32")
+
+        # each stage alone at reduced precision, then both, against fp32 frames
+        print()
+        print("%-10s %-12s %10s %14s" % ("precision", "stage", "PSNR [dB]", "render [s]"))
+        print("%-10s %-12s %10s %14.2f" % ("fp32", "-", "-", reference_seconds))
+        for precision in args.precisions:
+            coeff = coefficients(precision)
+            stages = [
+                ("audio2coeff", coeff, "fp32"),
+                ("facerender", reference_coeff, precision),
+                ("end_to_end", coeff, precision),
+            ]
+            for stage, coeff_path, render_precision in stages:
+                result, seconds = frames(coeff_path, render_precision)
+                print(
+                    "%-10s %-12s %10.2f %14.2f"
+                    % (precision, stage, psnr(reference, result), seconds)
+                )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="PSNR of the first frames rendered at reduced precision, per stage, against fp32"
+    )
+    parser.add_argument("--source_image", required=True, help="path to source image")
+    parser.add_argument("--driven_audio", required=True, help="path to driven audio")
+    parser.add_argument(
+        "--precisions",
+        nargs="+",
+        default=["bf16", "fp16"],
+        choices=PRECISIONS[1:],
+        help="reduced precisions to compare against fp32",
+    )
+    parser.add_argument(
+        "--frames", type=int, default=50, help="number of frames to render and compare"
+    )
+    parser.add_argument("--checkpoint_dir", default="./checkpoints")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument(
+        "--preprocess",
+        default="crop",
+        choices=["crop", "extcrop", "resize", "full", "extfull"],
+    )
+    parser.add_argument("--pose_style", type=int, default=0)
+    parser.add_argument(
+        "--batch_size", type=int, default=0, help="frames per facerender call, 0: auto"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cpu", dest="cpu", action="store_true")
+
+    args = parser.parse_args()
+    if torch.cuda.is_available() and not args.cpu:
+        args.device = "cuda"
+    else:
+        args.device = "cpu"
+
+    main(args)
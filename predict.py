@@ -1,6 +1,7 @@
 """run bash scripts/download_models.sh first to prepare the weights file"""
 import os
 import shutil
+import tempfile
 from argparse import Namespace
 from utils.utils.preprocess import CropAndExtract
 from utils.test_audio2coeff import Audio2Coeff
@@ -8,6 +9,8 @@ from utils.facerender.animate import AnimateFromCoeff
 from utils.generate_batch import get_data
 from utils.generate_facerender_batch import get_facerender_data
 from utils.utils.init_path import init_path
+from utils.utils.safetensor_helper import release_safetensor_checkpoint
+from utils.utils.workspace import JobWorkspace
 from cog import BasePredictor, Input, Path
 
 checkpoints = "checkpoints"
@@ -28,16 +31,17 @@ class Predictor(BasePredictor):
             device,
         )
 
-        self.animate_from_coeff = {
-            "full": AnimateFromCoeff(
-                sadtalker_paths,
-                device,
-            ),
-            "others": AnimateFromCoeff(
-                sadtalker_paths,
-                device,
-            ),
-        }
+        # one generator / kp detector, with a mapping net for `full` and one
+        # for the other preprocess modes
+        self.animate_from_coeff = AnimateFromCoeff(
+            sadtalker_paths,
+            device,
+        )
+        if sadtalker_paths["use_safetensor"]:
+            release_safetensor_checkpoint(sadtalker_paths["checkpoint"])
+        self.animate_from_coeff.add_mapping(
+            init_path(checkpoints, os.path.join("config"), preprocess="full")
+        )
 
     def predict(
         self,
@@ -72,12 +76,6 @@ class Predictor(BasePredictor):
     ) -> Path:
         """Run a single prediction on the model"""
 
-        animate_from_coeff = (
-            self.animate_from_coeff["full"]
-            if preprocess == "full"
-            else self.animate_from_coeff["others"]
-        )
-
         args = load_default()
         args.pic_path = str(source_image)
         args.audio_path = str(driven_audio)
@@ -86,98 +84,106 @@ class Predictor(BasePredictor):
         args.ref_eyeblink = None if ref_eyeblink is None else str(ref_eyeblink)
         args.ref_pose = None if ref_pose is None else str(ref_pose)
 
-        # crop image and extract 3dmm from image
-        results_dir = "results"
-        if os.path.exists(results_dir):
-            shutil.rmtree(results_dir)
-        os.makedirs(results_dir)
-        first_frame_dir = os.path.join(results_dir, "first_frame_dir")
-        os.makedirs(first_frame_dir)
-
-        print("3DMM Extraction for source image")
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(
-            args.pic_path, first_frame_dir, preprocess, source_image_flag=True
-        )
-        if first_coeff_path is None:
-            print("Can't get the coeffs of the input")
-            return
-
-        if ref_eyeblink is not None:
-            ref_eyeblink_videoname = os.path.splitext(os.path.split(ref_eyeblink)[-1])[
-                0
-            ]
-            ref_eyeblink_frame_dir = os.path.join(results_dir, ref_eyeblink_videoname)
-            os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
-            print("3DMM Extraction for the reference video providing eye blinking")
-            ref_eyeblink_coeff_path, _, _ = self.preprocess_model.generate(
-                ref_eyeblink, ref_eyeblink_frame_dir
+        # every intermediate file of this call lives in its own workspace,
+        # removed however the call ends
+        with JobWorkspace(prefix="predict_") as workspace:
+            results_dir = workspace.path
+            # crop image and extract 3dmm from image
+            first_frame_dir = os.path.join(results_dir, "first_frame_dir")
+            os.makedirs(first_frame_dir)
+
+            print("3DMM Extraction for source image")
+            (
+                first_coeff_path,
+                crop_pic_path,
+                crop_info,
+            ) = self.preprocess_model.generate(
+                args.pic_path, first_frame_dir, preprocess, source_image_flag=True
             )
-        else:
-            ref_eyeblink_coeff_path = None
-
-        if ref_pose is not None:
-            if ref_pose == ref_eyeblink:
-                ref_pose_coeff_path = ref_eyeblink_coeff_path
-            else:
-                ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
-                ref_pose_frame_dir = os.path.join(results_dir, ref_pose_videoname)
-                os.makedirs(ref_pose_frame_dir, exist_ok=True)
-                print("3DMM Extraction for the reference video providing pose")
-                ref_pose_coeff_path, _, _ = self.preprocess_model.generate(
-                    ref_pose, ref_pose_frame_dir
+            if first_coeff_path is None:
+                print("Can't get the coeffs of the input")
+                return
+
+            if ref_eyeblink is not None:
+                ref_eyeblink_videoname = os.path.splitext(
+                    os.path.split(ref_eyeblink)[-1]
+                )[0]
+                ref_eyeblink_frame_dir = os.path.join(
+                    results_dir, ref_eyeblink_videoname
+                )
+                os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
+                print("3DMM Extraction for the reference video providing eye blinking")
+                ref_eyeblink_coeff_path, _, _ = self.preprocess_model.generate(
+                    ref_eyeblink, ref_eyeblink_frame_dir
                 )
-        else:
-            ref_pose_coeff_path = None
+            else:
+                ref_eyeblink_coeff_path = None
+
+            if ref_pose is not None:
+                if ref_pose == ref_eyeblink:
+                    ref_pose_coeff_path = ref_eyeblink_coeff_path
+                else:
+                    ref_pose_videoname = os.path.splitext(
+                        os.path.split(ref_pose)[-1]
+                    )[0]
+                    ref_pose_frame_dir = os.path.join(results_dir, ref_pose_videoname)
+                    os.makedirs(ref_pose_frame_dir, exist_ok=True)
+                    print("3DMM Extraction for the reference video providing pose")
+                    ref_pose_coeff_path, _, _ = self.preprocess_model.generate(
+                        ref_pose, ref_pose_frame_dir
+                    )
+            else:
+                ref_pose_coeff_path = None
 
-        # audio2ceoff
-        batch = get_data(
-            first_coeff_path,
-            args.audio_path,
-            device,
-            ref_eyeblink_coeff_path,
-            still=still,
-        )
-        coeff_path = self.audio_to_coeff.generate(
-            batch, results_dir, args.pose_style, ref_pose_coeff_path
-        )
-        # coeff2video
-        print("coeff2video")
-        data = get_facerender_data(
-            coeff_path,
-            crop_pic_path,
-            first_coeff_path,
-            args.audio_path,
-            args.batch_size,
-            args.input_yaw,
-            args.input_pitch,
-            args.input_roll,
-            expression_scale=args.expression_scale,
-            still_mode=still,
-            preprocess=preprocess,
-        )
-        animate_from_coeff.generate(
-            data,
-            results_dir,
-            args.pic_path,
-            crop_info,
-            enhancer=enhancer,
-            background_enhancer=args.background_enhancer,
-            preprocess=preprocess,
-        )
+            # audio2ceoff
+            batch = get_data(
+                first_coeff_path,
+                args.audio_path,
+                device,
+                ref_eyeblink_coeff_path,
+                still=still,
+            )
+            coeff_path = self.audio_to_coeff.generate(
+                batch, results_dir, args.pose_style, ref_pose_coeff_path
+            )
+            # coeff2video
+            print("coeff2video")
+            data = get_facerender_data(
+                coeff_path,
+                crop_pic_path,
+                first_coeff_path,
+                args.audio_path,
+                args.batch_size,
+                args.input_yaw,
+                args.input_pitch,
+                args.input_roll,
+                expression_scale=args.expression_scale,
+                still_mode=still,
+                preprocess=preprocess,
+            )
+            mp4_path = self.animate_from_coeff.generate(
+                data,
+                results_dir,
+                args.pic_path,
+                crop_info,
+                enhancer=enhancer,
+                background_enhancer=args.background_enhancer,
+                preprocess=preprocess,
+                temp_dir=results_dir,
+            )
 
-        output = "/tmp/out.mp4"
-        mp4_path = os.path.join(
-            results_dir, [f for f in os.listdir(results_dir) if "enhanced.mp4" in f][0]
-        )
-        shutil.copy(mp4_path, output)
+            # the workspace is gone once predict returns, the video is copied to
+            # a directory of its own for cog to upload
+            output = os.path.join(tempfile.mkdtemp(prefix="sadtalker_out_"), "out.mp4")
+            shutil.copy(mp4_path, output)
 
-        return Path(output)
+            return Path(output)
 
 
 def load_default():
     return Namespace(
         pose_style=0,
-        batch_size=2,
+        batch_size=0,
         expression_scale=1.0,
         input_yaw=None,
         input_pitch=None,
@@ -0,0 +1,560 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+import traceback
+import multiprocessing as mp
+from argparse import ArgumentParser
+
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import FileResponse
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def worker_main(
+    worker_id,
+    checkpoint_path,
+    config_path,
+    task_queue,
+    event_queue,
+    cancelled,
+    threads_per_worker,
+    use_tmpfs=False,
+    warmup=False,
+):
+    """
+    Worker process: holds one warm SadTalker and renders jobs from task_queue
+    until it receives None.
+    """
+    import torch
+    from utils.main import SadTalker
+
+    if threads_per_worker:
+        torch.set_num_threads(threads_per_worker)
+
+    # job scratch files live in a workspace SadTalker.test removes whether the
+    # job finishes, fails or is cancelled
+    sad_talker = SadTalker(
+        checkpoint_path, config_path, lazy_load=False, use_tmpfs=use_tmpfs
+    )
+    report = None
+    if warmup:
+        from utils.warmup import warm_up
+
+        # the worker only reports ready once its latency is steady
+        report = warm_up(sad_talker)
+    event_queue.put(("ready", worker_id, report))
+
+    while True:
+        job = task_queue.get()
+        if job is None:
+            break
+        job_id = job["id"]
+        # first thing after taking the task, so the server knows whose job it
+        # is should this worker die
+        event_queue.put(("dequeued", job_id, worker_id))
+        if job_id in cancelled:
+            event_queue.put(("cancelled", job_id, None))
+            continue
+
+        def progress_callback(stage, fraction):
+            # "done" comes after every output is written, too late to cancel
+            if stage != "done" and job_id in cancelled:
+                raise JobCancelled(job_id)
+            event_queue.put(("progress", job_id, (stage, fraction)))
+
+        event_queue.put(("started", job_id, worker_id))
+        try:
+            result = sad_talker.test(
+                job["source_image"],
+                job["driven_audio"],
+                preprocess=job["preprocess"],
+                still_mode=job["still_mode"],
+                use_enhancer=job["use_enhancer"],
+                batch_size=job["batch_size"],
+                size=job["size"],
+                pose_style=job["pose_style"],
+                exp_scale=job["exp_scale"],
+                result_dir=job["result_dir"],
+                progress_callback=progress_callback,
+            )
+            event_queue.put(("done", job_id, result))
+        except JobCancelled:
+            event_queue.put(("cancelled", job_id, None))
+        except Exception as e:
+            traceback.print_exc()
+            event_queue.put(("failed", job_id, repr(e)))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobManager:
+    """
+    Keeps the job table of the server and a pool of worker processes that each
+    hold warm models. At most max_queue jobs may wait for a worker, further
+    submissions are rejected until the queue drains. Finished jobs and their
+    outputs are removed job_ttl seconds after they finish, 0 keeps them.
+
+    A worker that dies is restarted after restart_backoff seconds, doubling
+    with every crash before it reports ready again (at most 5 minutes). After
+    max_restarts such crashes in a row it is given up and the server runs
+    degraded on the remaining workers.
+    """
+
+    def __init__(
+        self,
+        checkpoint_path,
+        config_path,
+        work_dir,
+        num_workers=1,
+        max_queue=8,
+        threads_per_worker=None,
+        use_tmpfs=False,
+        warmup=False,
+        job_ttl=3600,
+        restart_backoff=1.0,
+        max_restarts=5,
+    ):
+        self.checkpoint_path = checkpoint_path
+        self.config_path = config_path
+        self.work_dir = work_dir
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.threads_per_worker = threads_per_worker
+        self.use_tmpfs = use_tmpfs
+        self.warmup = warmup
+        self.job_ttl = job_ttl
+        self.restart_backoff = restart_backoff
+        self.max_restarts = max_restarts
+
+        # spawn keeps workers independent of the parent on every platform
+        self.ctx = mp.get_context("spawn")
+        self.jobs = {}
+        # ids of the tasks in task_queue, cancelled ones included until a
+        # worker dequeues them
+        self.queued = set()
+        # worker id -> id of the job it took from task_queue and has not
+        # finished, failed or dropped yet
+        self.current = {}
+        self.lock = threading.Lock()
+        self.workers = []
+        self.stopping = threading.Event()
+        self.ready_workers = set()
+        # worker id -> crashes since it was last ready
+        self.restarts = {}
+        # worker id -> time of the pending restart
+        self.restart_at = {}
+        self.failed_workers = set()
+        self.warmup_reports = {}
+
+    def spawn_worker(self, worker_id):
+        process = self.ctx.Process(
+            target=worker_main,
+            args=(
+                worker_id,
+                self.checkpoint_path,
+                self.config_path,
+                self.task_queue,
+                self.event_queue,
+                self.cancelled,
+                self.threads_per_worker,
+                self.use_tmpfs,
+                self.warmup,
+            ),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def start(self):
+        self.manager = self.ctx.Manager()
+        self.cancelled = self.manager.dict()
+        self.task_queue = self.ctx.Queue()
+        self.event_queue = self.ctx.Queue()
+
+        self.workers = [
+            self.spawn_worker(worker_id) for worker_id in range(self.num_workers)
+        ]
+
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+        self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+
+    def monitor(self, interval=1.0):
+        """
+        Replaces workers that died (OOM, a crash in ffmpeg or CUDA), with
+        backoff; the listener fails the job the dead worker was running. Also
+        prunes expired jobs.
+        """
+        while not self.stopping.wait(interval):
+            now = time.time()
+            for worker_id, process in enumerate(self.workers):
+                if process.exitcode is None or worker_id in self.failed_workers:
+                    continue
+                if worker_id in self.restart_at:
+                    if now >= self.restart_at[worker_id]:
+                        with self.lock:
+                            del self.restart_at[worker_id]
+                        self.workers[worker_id] = self.spawn_worker(worker_id)
+                    continue
+
+                # queued after every event the worker sent before it died
+                self.event_queue.put(("exited", worker_id, process.exitcode))
+                with self.lock:
+                    restarts = self.restarts.get(worker_id, 0) + 1
+                    self.restarts[worker_id] = restarts
+                    if restarts > self.max_restarts:
+                        self.failed_workers.add(worker_id)
+                    else:
+                        delay = min(self.restart_backoff * 2 ** (restarts - 1), 300)
+                        self.restart_at[worker_id] = now + delay
+                if worker_id in self.failed_workers:
+                    print(
+                        "worker %d exited with code %s, %d crashes in a row, giving up"
+                        % (worker_id, process.exitcode, restarts)
+                    )
+                else:
+                    print(
+                        "worker %d exited with code %s, restarting it in %.1fs"
+                        % (worker_id, process.exitcode, delay)
+                    )
+            self.prune()
+
+    def prune(self):
+        if not self.job_ttl:
+            return
+        now = time.time()
+        with self.lock:
+            # a cancelled job stays until a worker has dropped its task
+            busy = self.queued | set(self.current.values())
+            expired = [
+                job
+                for job in self.jobs.values()
+                if job["finished"] is not None
+                and now - job["finished"] > self.job_ttl
+                and job["id"] not in busy
+            ]
+            for job in expired:
+                del self.jobs[job["id"]]
+        for job in expired:
+            shutil.rmtree(job["dir"], ignore_errors=True)
+            shutil.rmtree(job["uploads"], ignore_errors=True)
+
+    def stop(self):
+        self.stopping.set()
+        self.monitor_thread.join()
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for process in self.workers:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.event_queue.put(None)
+        self.manager.shutdown()
+
+    def listen(self):
+        while True:
+            event = self.event_queue.get()
+            if event is None:
+                break
+            kind, key, payload = event
+
+            with self.lock:
+                if kind == "ready":
+                    self.ready_workers.add(key)
+                    self.restarts.pop(key, None)
+                    if payload is not None:
+                        self.warmup_reports[key] = payload
+                    continue
+                if kind == "exited":
+                    self.ready_workers.discard(key)
+                    # the job the worker had taken, whether it started it or not
+                    job = self.jobs.get(self.current.pop(key, None))
+                    if job is not None:
+                        if job["status"] in ["cancelled", "cancelling"]:
+                            job["status"] = "cancelled"
+                        else:
+                            job["status"] = "failed"
+                            job["error"] = "worker exited with code %s" % payload
+                        self.finish(job)
+                    continue
+                if kind == "dequeued":
+                    self.queued.discard(key)
+                    self.current[payload] = key
+
+                job = self.jobs.get(key)
+                if job is None:
+                    continue
+                if kind == "dequeued":
+                    job["worker"] = payload
+                elif kind == "started":
+                    job["worker"] = payload
+                    job["started"] = time.time()
+                    if job["status"] == "cancelled" or key in self.cancelled:
+                        # cancelled after the worker checked: it stops at the
+                        # next progress report, the job is not finished before
+                        job["status"] = "cancelling"
+                        job["finished"] = None
+                    else:
+                        job["status"] = "running"
+                elif kind == "progress":
+                    job["stage"], job["progress"] = payload
+                elif kind == "done":
+                    job["status"] = "done"
+                    job["progress"] = 1.0
+                    job["result"] = payload
+                elif kind == "failed":
+                    job["status"] = "failed"
+                    job["error"] = payload
+                elif kind == "cancelled":
+                    job["status"] = "cancelled"
+
+                if kind in ["done", "failed", "cancelled"]:
+                    if self.current.get(job["worker"]) == key:
+                        del self.current[job["worker"]]
+                    self.finish(job)
+
+    def finish(self, job):
+        job["finished"] = time.time()
+        self.cancelled.pop(job["id"], None)
+        shutil.rmtree(job["uploads"], ignore_errors=True)
+
+    def ready(self):
+        # workers that were given up on do not hold back readiness
+        return bool(self.ready_workers) and len(self.ready_workers) + len(
+            self.failed_workers
+        ) == self.num_workers
+
+    def degraded(self):
+        return bool(self.failed_workers or self.restart_at)
+
+    def pending(self):
+        # what backpressure limits is the depth of task_queue, not the number
+        # of jobs reported as queued
+        return len(self.queued)
+
+    def submit(self, params, upload_dir):
+        with self.lock:
+            if self.pending() >= self.max_queue:
+                raise QueueFull()
+
+            job_id = uuid.uuid4().hex
+            job_dir = os.path.join(self.work_dir, job_id)
+            os.makedirs(job_dir, exist_ok=True)
+            task = dict(params, id=job_id, result_dir=job_dir)
+
+            self.jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "stage": None,
+                "progress": 0.0,
+                "result": None,
+                "error": None,
+                "worker": None,
+                "created": time.time(),
+                "finished": None,
+                "dir": job_dir,
+                "uploads": upload_dir,
+            }
+            self.task_queue.put(task)
+            self.queued.add(job_id)
+        return job_id
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] == "queued":
+                # the worker drops it when it reaches the front of the queue
+                job["status"] = "cancelled"
+                job["finished"] = time.time()
+                self.cancelled[job_id] = True
+            elif job["status"] == "running":
+                # checked by the worker at the next stage boundary
+                self.cancelled[job_id] = True
+                job["status"] = "cancelling"
+            return dict(job)
+
+
+def create_app(manager):
+    app = FastAPI()
+
+    def save_upload(upload, job_dir):
+        path = os.path.join(job_dir, os.path.basename(upload.filename))
+        with open(path, "wb") as f:
+            shutil.copyfileobj(upload.file, f)
+        return path
+
+    @app.get("/health")
+    def health():
+        with manager.lock:
+            return {
+                "workers": manager.num_workers,
+                "ready_workers": len(manager.ready_workers),
+                "ready": manager.ready(),
+                "degraded": manager.degraded(),
+                "restarting_workers": sorted(manager.restart_at),
+                "failed_workers": sorted(manager.failed_workers),
+                "queued": manager.pending(),
+                "max_queue": manager.max_queue,
+                "warmup": manager.warmup_reports,
+            }
+
+    @app.get("/ready")
+    def ready():
+        # readiness probe for the load balancer: 503 until every worker is warm
+        with manager.lock:
+            if not manager.ready():
+                raise HTTPException(status_code=503, detail="workers warming up")
+            return {"ready": True}
+
+    @app.post("/jobs", status_code=202)
+    def submit(
+        source_image: UploadFile = File(...),
+        driven_audio: UploadFile = File(...),
+        preprocess: str = Form("crop"),
+        still_mode: bool = Form(False),
+        use_enhancer: bool = Form(False),
+        batch_size: int = Form(0),
+        size: int = Form(256),
+        pose_style: int = Form(0),
+        exp_scale: float = Form(1.0),
+    ):
+        upload_dir = os.path.join(manager.work_dir, "uploads", uuid.uuid4().hex)
+        os.makedirs(upload_dir, exist_ok=True)
+        params = {
+            "source_image": save_upload(source_image, upload_dir),
+            "driven_audio": save_upload(driven_audio, upload_dir),
+            "preprocess": preprocess,
+            "still_mode": still_mode,
+            "use_enhancer": use_enhancer,
+            "batch_size": batch_size,
+            "size": size,
+            "pose_style": pose_style,
+            "exp_scale": exp_scale,
+        }
+        try:
+            job_id = manager.submit(params, upload_dir)
+        except QueueFull:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            raise HTTPException(
+                status_code=429,
+                detail="job queue is full, retry later",
+                headers={"Retry-After": "10"},
+            )
+        return {"job_id": job_id}
+
+    @app.get("/jobs/{job_id}")
+    def status(job_id: str):
+        job = manager.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="unknown job")
+        return job
+
+    @app.get("/jobs/{job_id}/result")
+    def result(job_id: str):
+        job = manager.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="unknown job")
+        if job["status"] != "done":
+            raise HTTPException(
+                status_code=409, detail="job is %s" % job["status"]
+            )
+        return FileResponse(job["result"]["video_path"], media_type="video/mp4")
+
+    @app.delete("/jobs/{job_id}")
+    def cancel(job_id: str):
+        job = manager.cancel(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="unknown job")
+        return job
+
+    @app.on_event("shutdown")
+    def shutdown():
+        manager.stop()
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument(
+        "--checkpoint_dir", default="./checkpoints", help="path to checkpoints"
+    )
+    parser.add_argument("--config_dir", default="./config", help="path to config")
+    parser.add_argument(
+        "--work_dir", default="./results/server", help="uploads and job outputs"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="worker processes with warm models"
+    )
+    parser.add_argument(
+        "--max_queue",
+        type=int,
+        default=8,
+        help="jobs allowed to wait for a worker before submissions get HTTP 429",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="torch threads per worker, defaults to cpu_count // workers",
+    )
+    parser.add_argument(
+        "--tmpfs",
+        action="store_true",
+        help="keep job scratch files in /dev/shm instead of the system temp dir",
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="run synthetic jobs in every worker until latency is steady before reporting ready",
+    )
+    parser.add_argument(
+        "--job_ttl",
+        type=float,
+        default=3600,
+        help="seconds a finished job and its video are kept, 0 keeps them forever",
+    )
+    parser.add_argument(
+        "--max_restarts",
+        type=int,
+        default=5,
+        help="crashes in a row after which a worker is not restarted again",
+    )
+    args = parser.parse_args()
+
+    threads_per_worker = args.threads_per_worker or max(
+        1, (os.cpu_count() or 1) // args.workers
+    )
+    manager = JobManager(
+        os.path.abspath(args.checkpoint_dir),
+        os.path.abspath(args.config_dir),
+        os.path.abspath(args.work_dir),
+        num_workers=args.workers,
+        max_queue=args.max_queue,
+        threads_per_worker=threads_per_worker,
+        use_tmpfs=args.tmpfs,
+        warmup=args.warmup,
+        job_ttl=args.job_ttl,
+        max_restarts=args.max_restarts,
+    )
+    manager.start()
+    uvicorn.run(create_app(manager), host=args.host, port=args.port)
@@ -0,0 +1,50 @@
+import shutil
+import subprocess
+
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+if shutil.which("ffmpeg") is None:
+    pytest.skip("ffmpeg is not installed", allow_module_level=True)
+
+from utils.utils.videoio import concat_videos
+
+
+def make_segment(path, frames):
+    subprocess.run(
+        ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+         "-i", "testsrc=size=64x64:rate=25", "-frames:v", str(frames),
+         "-pix_fmt", "yuv420p", path],
+        check=True,
+    )
+
+
+def count_frames(path):
+    stream = cv2.VideoCapture(path)
+    frames = 0
+    while stream.read()[0]:
+        frames += 1
+    stream.release()
+    return frames
+
+
+def test_concat_two_segments(tmp_path):
+    # spaces and quotes in paths go through the list file and argv untouched
+    segment_dir = tmp_path / "seg 'dir'"
+    segment_dir.mkdir()
+    paths = [str(segment_dir / "a b.mp4"), str(segment_dir / "c'd.mp4")]
+    make_segment(paths[0], 10)
+    make_segment(paths[1], 5)
+
+    save_path = str(tmp_path / "out put.mp4")
+    concat_videos(paths, save_path, temp_dir=str(tmp_path))
+
+    assert count_frames(save_path) == 15
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["out put.mp4", "seg 'dir'"]
+
+
+def test_concat_raises_when_ffmpeg_fails(tmp_path):
+    with pytest.raises(subprocess.CalledProcessError):
+        concat_videos([str(tmp_path / "missing.mp4")], str(tmp_path / "out.mp4"))
+    # the list file is removed either way
+    assert list(tmp_path.iterdir()) == []
@@ -1,7 +1,8 @@
-from tqdm import tqdm
 import torch
 from torch import nn
 
+from ..utils.mel_runs import encode_runs
+
 
 class Audio2Exp(nn.Module):
     def __init__(self, netG, cfg, device, prepare_training_loss=False):
@@ -10,32 +11,29 @@ class Audio2Exp(nn.Module):
         self.device = device
         self.netG = netG.to(device)
 
-    def test(self, batch):
+    def test(self, batch, chunk_size=None, silence_db=None):
+        """
+        The expression of a frame depends only on its own mel window, ref and
+        blink ratio. The audio encoder runs once per run of identical mel
+        windows (and of windows at most silence_db dB loud, see
+        utils.mel_runs), chunk_size windows per call, and the cheap mapping
+        then runs on all frames at once. The default chunk is thousands of
+        windows on GPU and 64 on CPU, where bigger batches fall out of cache
+        and get slower again.
+        """
 
         mel_input = batch['indiv_mels']                         # bs T 1 80 16
-        bs = mel_input.shape[0]
-        T = mel_input.shape[1]
-
-        exp_coeff_pred = []
-
-        for i in tqdm(range(0, T, 10),'audio2exp:'): # every 10 frames
-            
-            current_mel_input = mel_input[:,i:i+10]
-
-            #ref = batch['ref'][:, :, :64].repeat((1,current_mel_input.shape[1],1))           #bs T 64
-            ref = batch['ref'][:, :, :64][:, i:i+10]
-            ratio = batch['ratio_gt'][:, i:i+10]                               #bs T
+        if chunk_size is None:
+            chunk_size = 4096 if mel_input.is_cuda else 64
 
-            audiox = current_mel_input.view(-1, 1, 80, 16)                  # bs*T 1 80 16
+        audiox = mel_input.reshape(-1, 1, 80, 16)                # bs*T 1 80 16
+        audio_emb = encode_runs(self.netG.encode, audiox, chunk_size, silence_db, 'audio2exp:')
 
-            curr_exp_coeff_pred  = self.netG(audiox, ref, ratio)         # bs T 64 
-
-            exp_coeff_pred += [curr_exp_coeff_pred]
+        ref = batch['ref'][:, :, :64]                           # bs T 64
+        ratio = batch['ratio_gt']                               # bs T
 
         # BS x T x 64
         results_dict = {
-            'exp_coeff_pred': torch.cat(exp_coeff_pred, axis=1)
+            'exp_coeff_pred': self.netG.decode(audio_emb, ref, ratio)
             }
         return results_dict
-
-
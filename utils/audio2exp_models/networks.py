@@ -64,8 +64,15 @@ class SimpleWrapperV2(nn.Module):
         #nn.init.constant_(self.mapping1.weight, 0.)
         nn.init.constant_(self.mapping1.bias, 0.)
 
+    def encode(self, x):
+        # (n, 1, 80, 16) mel windows -> (n, 512)
+        return self.audio_encoder(x).view(x.size(0), -1)
+
     def forward(self, x, ref, ratio):
-        x = self.audio_encoder(x).view(x.size(0), -1)
+        return self.decode(self.encode(x), ref, ratio)
+
+    def decode(self, x, ref, ratio):
+        # x: encode output of the bs*T windows, ref bs T 64, ratio bs T
         ref_reshape = ref.reshape(x.size(0), -1)
         ratio = ratio.reshape(x.size(0), -1)
         
@@ -3,10 +3,15 @@ from torch import nn
 from .cvae import CVAE
 from .discriminator import PoseSequenceDiscriminator
 from .audio_encoder import AudioEncoder
+from ..utils.mel_runs import encode_runs
+from ..utils.inference_build import meta_nbytes
 
 
 class Audio2Pose(nn.Module):
-    def __init__(self, cfg, wav2lip_checkpoint, device="cuda"):
+    # checkpoint entries of the submodules that are not built for inference
+    training_only_prefixes = ("netD_motion.", "netG.encoder.")
+
+    def __init__(self, cfg, wav2lip_checkpoint, device="cuda", inference_only=False):
         super().__init__()
         self.cfg = cfg
         self.seq_len = cfg.MODEL.CVAE.SEQ_LEN
@@ -18,8 +23,20 @@ class Audio2Pose(nn.Module):
         for param in self.audio_encoder.parameters():
             param.requires_grad = False
 
-        self.netG = CVAE(cfg)
-        self.netD_motion = PoseSequenceDiscriminator(cfg)
+        self.netG = CVAE(cfg, inference_only=inference_only)
+        if inference_only:
+            # `test` uses neither the motion discriminator nor the CVAE encoder
+            self.netD_motion = None
+        else:
+            self.netD_motion = PoseSequenceDiscriminator(cfg)
+
+    @staticmethod
+    def training_only_nbytes(cfg):
+        sizes = [
+            meta_nbytes(lambda: PoseSequenceDiscriminator(cfg)),
+            meta_nbytes(lambda: CVAE.build_encoder(cfg)),
+        ]
+        return None if None in sizes else sum(sizes)
 
     def forward(self, x):
         batch = {}
@@ -48,12 +65,44 @@ class Audio2Pose(nn.Module):
 
         return batch
 
-    def test(self, x):
+    def encode_audio(self, indiv_mels, chunk_size=None, silence_db=None):
+        """
+        (bs, T, 1, 80, 16) mel windows -> (bs, T, 512) embeddings, computed
+        once per run of identical (or silent, see utils.mel_runs) windows,
+        chunk_size windows per encoder call; the defaults are those of
+        Audio2Exp.test.
+        """
+        if chunk_size is None:
+            chunk_size = 4096 if indiv_mels.is_cuda else 64
+        bs, T = indiv_mels.shape[:2]
+        audio_emb = encode_runs(
+            lambda mels: self.audio_encoder(mels.unsqueeze(0))[0],
+            indiv_mels.reshape((bs * T,) + indiv_mels.shape[2:]),
+            chunk_size,
+            silence_db,
+        )
+        return audio_emb.reshape(bs, T, -1)
+
+    def test(self, x, seed=None, silence_db=None):
+        """
+        The sequence is cut into seq_len chunks, the last one taking the final
+        seq_len frames (front-padded when the audio is shorter), and every
+        chunk is decoded from its own z. Chunks are independent given z, so
+        they all go through the CVAE decoder as one batch. seed makes the z
+        draws reproducible, otherwise the global RNG is used. silence_db is
+        passed to encode_audio.
+
+        For a single audio (bs 1), x['class'] may hold several pose styles;
+        each gets its own sequence, the audio is encoded once for all of them.
+        """
         batch = {}
         ref = x["ref"]  # bs 1 70
         batch["ref"] = x["ref"][:, 0, -6:]
         batch["class"] = x["class"]
-        bs = ref.shape[0]
+        # one pose sequence per class id
+        bs = batch["class"].shape[0]
+        if bs != ref.shape[0]:
+            batch["ref"] = batch["ref"].expand(bs, -1)
 
         indiv_mels = x["indiv_mels"]  # bs T 1 80 16
         indiv_mels_use = indiv_mels[:, 1:]  # we regard the ref as the first frame
@@ -63,7 +112,6 @@ class Audio2Pose(nn.Module):
         #
         div = num_frames // self.seq_len
         re = num_frames % self.seq_len
-        audio_emb_list = []
         pose_motion_pred_list = [
             torch.zeros(
                 batch["ref"].unsqueeze(1).shape,
@@ -72,31 +120,40 @@ class Audio2Pose(nn.Module):
             )
         ]
 
-        for i in range(div):
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch["z"] = z
-            audio_emb = self.audio_encoder(
-                indiv_mels_use[:, i * self.seq_len : (i + 1) * self.seq_len, :, :, :]
-            )  # bs seq_len 512
-            batch["audio_emb"] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(
-                batch["pose_motion_pred"]
-            )  # list of bs seq_len 6
-
-        if re != 0:
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch["z"] = z
-            audio_emb = self.audio_encoder(
-                indiv_mels_use[:, -1 * self.seq_len :, :, :, :]
-            )  # bs seq_len  512
-            if audio_emb.shape[1] != self.seq_len:
-                pad_dim = self.seq_len - audio_emb.shape[1]
-                pad_audio_emb = audio_emb[:, :1].repeat(1, pad_dim, 1)
-                audio_emb = torch.cat([pad_audio_emb, audio_emb], 1)
-            batch["audio_emb"] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch["pose_motion_pred"][:, -1 * re :, :])
+        if num_frames > 0:
+            # every frame is encoded once, the chunks are slices of the embedding
+            audio_emb = self.encode_audio(indiv_mels_use, silence_db=silence_db)  # bs num_frames 512
+            audio_emb = audio_emb.expand(bs, -1, -1)
+            chunks = [
+                audio_emb[:, i * self.seq_len : (i + 1) * self.seq_len]
+                for i in range(div)
+            ]
+            if re != 0:
+                last = audio_emb[:, -1 * self.seq_len :]  # bs seq_len 512
+                if last.shape[1] != self.seq_len:
+                    pad_dim = self.seq_len - last.shape[1]
+                    pad_audio_emb = last[:, :1].repeat(1, pad_dim, 1)
+                    last = torch.cat([pad_audio_emb, last], 1)
+                chunks.append(last)
+
+            num_chunks = len(chunks)
+            generator = None if seed is None else torch.Generator().manual_seed(seed)
+            z = torch.randn(num_chunks, bs, self.latent_dim, generator=generator)
+            # chunk-major batch of num_chunks * bs sequences
+            decoded = self.netG.test(
+                {
+                    "z": z.reshape(num_chunks * bs, -1).to(ref.device),
+                    "class": batch["class"].repeat(num_chunks),
+                    "ref": batch["ref"].repeat(num_chunks, 1),
+                    "audio_emb": torch.cat(chunks, dim=0),
+                }
+            )
+            pose_motion = decoded["pose_motion_pred"].reshape(
+                num_chunks, bs, self.seq_len, -1
+            )  # num_chunks bs seq_len 6
+            pose_motion_pred_list += [pose_motion[i] for i in range(div)]
+            if re != 0:
+                pose_motion_pred_list.append(pose_motion[-1][:, -1 * re :, :])
 
         pose_motion_pred = torch.cat(pose_motion_pred_list, dim=1)
         batch["pose_motion_pred"] = pose_motion_pred
@@ -12,9 +12,8 @@ def class2onehot(idx, class_num):
 
 
 class CVAE(nn.Module):
-    def __init__(self, cfg):
+    def __init__(self, cfg, inference_only=False):
         super().__init__()
-        encoder_layer_sizes = cfg.MODEL.CVAE.ENCODER_LAYER_SIZES
         decoder_layer_sizes = cfg.MODEL.CVAE.DECODER_LAYER_SIZES
         latent_size = cfg.MODEL.CVAE.LATENT_SIZE
         num_classes = cfg.DATASET.NUM_CLASSES
@@ -24,14 +23,8 @@ class CVAE(nn.Module):
 
         self.latent_size = latent_size
 
-        self.encoder = ENCODER(
-            encoder_layer_sizes,
-            latent_size,
-            num_classes,
-            audio_emb_in_size,
-            audio_emb_out_size,
-            seq_len,
-        )
+        # the encoder is only used by `forward` (training), `test` samples z
+        self.encoder = None if inference_only else self.build_encoder(cfg)
         self.decoder = DECODER(
             decoder_layer_sizes,
             latent_size,
@@ -41,6 +34,17 @@ class CVAE(nn.Module):
             seq_len,
         )
 
+    @staticmethod
+    def build_encoder(cfg):
+        return ENCODER(
+            list(cfg.MODEL.CVAE.ENCODER_LAYER_SIZES),
+            cfg.MODEL.CVAE.LATENT_SIZE,
+            cfg.DATASET.NUM_CLASSES,
+            cfg.MODEL.CVAE.AUDIO_EMB_IN_SIZE,
+            cfg.MODEL.CVAE.AUDIO_EMB_OUT_SIZE,
+            cfg.MODEL.CVAE.SEQ_LEN,
+        )
+
     def reparameterize(self, mu, logvar):
         std = torch.exp(0.5 * logvar)
         eps = torch.randn_like(std)
@@ -1,4 +1,5 @@
 # check the sync of 3dmm feature and the audio
+import os
 import cv2
 import numpy as np
 from ..face3d.models.bfm import ParametricFaceModel
@@ -11,7 +12,14 @@ from tqdm import tqdm
 
 # draft
 def gen_composed_video(
-    args, device, first_frame_coeff, coeff_path, audio_path, save_path, exp_dim=64
+    args,
+    device,
+    first_frame_coeff,
+    coeff_path,
+    audio_path,
+    save_path,
+    exp_dim=64,
+    temp_dir=None,
 ):
     coeff_first = scio.loadmat(first_frame_coeff)["full_3dmm"]
 
@@ -23,7 +31,9 @@ def gen_composed_video(
     coeff_full[:, 224:227] = coeff_pred[:, 64:67]  # 3 dim translation
     coeff_full[:, 254:] = coeff_pred[:, 67:]  # 3 dim translation
 
-    tmp_video_path = "/tmp/face3dtmp.mp4"
+    if temp_dir is None:
+        temp_dir = os.path.dirname(os.path.abspath(save_path))
+    tmp_video_path = os.path.join(temp_dir, "face3dtmp.mp4")
 
     facemodel = FaceReconModel(args)
 
@@ -51,3 +61,4 @@ def gen_composed_video(
         audio_path, tmp_video_path, save_path
     )
     subprocess.call(command, shell=platform.system() != "Windows")
+    os.remove(tmp_video_path)
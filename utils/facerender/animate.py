@@ -1,18 +1,12 @@
 import os
-import cv2
+import copy
 import yaml
-import numpy as np
 import warnings
-from skimage import img_as_ubyte
-import safetensors
-import safetensors.torch
 
 warnings.filterwarnings("ignore")
 
 
-import imageio
 import torch
-import torchvision
 
 
 from ..facerender.modules.keypoint_detector import HEEstimator, KPDetector
@@ -21,12 +15,23 @@ from ..facerender.modules.generator import (
     OcclusionAwareGenerator,
     OcclusionAwareSPADEGenerator,
 )
-from ..facerender.modules.make_animation import make_animation
+from ..facerender.modules.make_animation import (
+    ChunkTuner,
+    iter_animation,
+    prepare_animation_source,
+    to_uint8_frames,
+)
 
-from pydub import AudioSegment
-from ..utils.face_enhancer import enhancer_generator_with_len, enhancer_list
-from ..utils.paste_pic import paste_pic
-from ..utils.videoio import save_video_with_watermark
+from ..utils.safetensor_helper import get_safetensor_checkpoint
+from ..utils.inference_build import (
+    convert_sync_batchnorm,
+    fold_batchnorm,
+    fold_spectral_norm,
+    max_abs_diff,
+    meta_nbytes,
+    report_skipped,
+)
+from ..utils.init_path import preprocess_family
 
 try:
     import webui  # in webui
@@ -37,7 +42,15 @@ except:
 
 
 class AnimateFromCoeff:
-    def __init__(self, sadtalker_path, device):
+    """
+    One generator and keypoint detector shared by a MappingNet head per
+    preprocess family ('crop' and 'full', see init_path). The head of
+    sadtalker_path is loaded at construction, `add_mapping` adds others.
+    """
+
+    def __init__(
+        self, sadtalker_path, device, inference_only=True, verify_finalize=False
+    ):
         with open(sadtalker_path["facerender_yaml"]) as f:
             config = yaml.safe_load(f)
 
@@ -49,24 +62,29 @@ class AnimateFromCoeff:
             **config["model_params"]["kp_detector_params"],
             **config["model_params"]["common_params"],
         )
-        he_estimator = HEEstimator(
-            **config["model_params"]["he_estimator_params"],
-            **config["model_params"]["common_params"],
-        )
-        mapping = MappingNet(**config["model_params"]["mapping_params"])
+        def build_he_estimator():
+            return HEEstimator(
+                **config["model_params"]["he_estimator_params"],
+                **config["model_params"]["common_params"],
+            )
+
+        # make_animation never calls the head pose estimator, the mapping net
+        # predicts the pose from the coefficients instead.
+        if inference_only:
+            he_estimator = None
+            report_skipped("he_estimator", meta_nbytes(build_he_estimator))
+        else:
+            he_estimator = build_he_estimator()
+            he_estimator.to(device)
+            for param in he_estimator.parameters():
+                param.requires_grad = False
 
         generator.to(device)
         kp_extractor.to(device)
-        he_estimator.to(device)
-        mapping.to(device)
         for param in generator.parameters():
             param.requires_grad = False
         for param in kp_extractor.parameters():
             param.requires_grad = False
-        for param in he_estimator.parameters():
-            param.requires_grad = False
-        for param in mapping.parameters():
-            param.requires_grad = False
 
         if sadtalker_path is not None:
             if "checkpoint" in sadtalker_path:  # use safe tensor
@@ -88,6 +106,91 @@ class AnimateFromCoeff:
                 "Checkpoint should be specified for video head pose estimator."
             )
 
+        self.kp_extractor = kp_extractor
+        self.generator = generator
+        self.he_estimator = he_estimator
+
+        self.kp_extractor.eval()
+        self.generator.eval()
+        if self.he_estimator is not None:
+            self.he_estimator.eval()
+
+        self.device = device
+
+        if inference_only:
+            self.finalize(verify=verify_finalize)
+
+        self.mappings = {}
+        self.mapping = self.add_mapping(sadtalker_path)
+        # chunk sizes found by ChunkTuner, keyed by (size, device, precision)
+        self.chunk_sizes = {}
+
+    def finalize(self, verify=False, atol=1e-3):
+        """
+        Rewrites the loaded generator and keypoint detector for inference: the
+        spectral norm hooks of the SPADE decoder are folded into plain weights,
+        the synchronized batch norms become torch.nn ones and those right
+        after a conv are folded into it. With verify, a copy of the original
+        modules renders the same synthetic frame and a difference above atol
+        raises.
+        """
+        if verify:
+            reference = copy.deepcopy((self.kp_extractor, self.generator))
+        folded = fold_spectral_norm(self.generator)
+        print("Face Renderer: folded spectral norm of %d convs" % folded)
+        for model in [self.kp_extractor, self.generator]:
+            convert_sync_batchnorm(model)
+        folded = fold_batchnorm(self.kp_extractor) + fold_batchnorm(self.generator)
+        print("Face Renderer: folded %d batch norms into their convs" % folded)
+        if verify:
+            self.verify_finalized(*reference, atol=atol)
+
+    def verify_finalized(self, kp_extractor, generator, atol=1e-3):
+        """
+        Max abs output difference of the current modules against kp_extractor
+        and generator, on a random source frame and jittered keypoints.
+        """
+        gen = torch.Generator().manual_seed(0)
+        source = torch.rand(1, 3, 256, 256, generator=gen).to(self.device)
+        with torch.no_grad():
+            kp_reference = kp_extractor(source)
+            kp = self.kp_extractor(source)
+            noise = 0.05 * torch.randn(kp["value"].shape, generator=gen)
+            kp_driving = {"value": kp_reference["value"] + noise.to(self.device)}
+            out_reference = generator(
+                source, kp_driving=kp_driving, kp_source=kp_reference
+            )
+            out = self.generator(source, kp_driving=kp_driving, kp_source=kp_reference)
+
+        diffs = {
+            "kp_extractor": max_abs_diff(kp_reference, kp),
+            "generator": max_abs_diff(out_reference, out),
+        }
+        for name, diff in diffs.items():
+            print("Face Renderer: finalized %s, max abs diff %.2e" % (name, diff))
+        if max(diffs.values()) > atol:
+            raise RuntimeError(
+                "Finalized face renderer differs from the original by more than %g"
+                % atol
+            )
+        return diffs
+
+    def add_mapping(self, sadtalker_path):
+        """
+        Loads the MappingNet head for the preprocess family of sadtalker_path,
+        unless it is already loaded, and returns it.
+        """
+        family = sadtalker_path["preprocess_family"]
+        if family in self.mappings:
+            return self.mappings[family]
+
+        with open(sadtalker_path["facerender_yaml"]) as f:
+            config = yaml.safe_load(f)
+        mapping = MappingNet(**config["model_params"]["mapping_params"])
+        mapping.to(self.device)
+        for param in mapping.parameters():
+            param.requires_grad = False
+
         if sadtalker_path["mappingnet_checkpoint"] is not None:
             self.load_cpk_mapping(
                 sadtalker_path["mappingnet_checkpoint"], mapping=mapping
@@ -97,17 +200,9 @@ class AnimateFromCoeff:
                 "Checkpoint should be specified for video head pose estimator."
             )
 
-        self.kp_extractor = kp_extractor
-        self.generator = generator
-        self.he_estimator = he_estimator
-        self.mapping = mapping
-
-        self.kp_extractor.eval()
-        self.generator.eval()
-        self.he_estimator.eval()
-        self.mapping.eval()
-
-        self.device = device
+        mapping.eval()
+        self.mappings[family] = mapping
+        return mapping
 
     def load_cpk_facevid2vid_safetensor(
         self,
@@ -117,26 +212,14 @@ class AnimateFromCoeff:
         he_estimator=None,
         device="cpu",
     ):
-        checkpoint = safetensors.torch.load_file(checkpoint_path)
+        checkpoint = get_safetensor_checkpoint(checkpoint_path)
 
         if generator is not None:
-            x_generator = {}
-            for k, v in checkpoint.items():
-                if "generator" in k:
-                    x_generator[k.replace("generator.", "")] = v
-            generator.load_state_dict(x_generator)
+            generator.load_state_dict(checkpoint.load_x("generator"))
         if kp_detector is not None:
-            x_generator = {}
-            for k, v in checkpoint.items():
-                if "kp_extractor" in k:
-                    x_generator[k.replace("kp_extractor.", "")] = v
-            kp_detector.load_state_dict(x_generator)
+            kp_detector.load_state_dict(checkpoint.load_x("kp_extractor"))
         if he_estimator is not None:
-            x_generator = {}
-            for k, v in checkpoint.items():
-                if "he_estimator" in k:
-                    x_generator[k.replace("he_estimator.", "")] = v
-            he_estimator.load_state_dict(x_generator)
+            he_estimator.load_state_dict(checkpoint.load_x("he_estimator"))
 
         return None
 
@@ -208,20 +291,55 @@ class AnimateFromCoeff:
 
         return checkpoint["epoch"]
 
-    def generate(
+    def mapping_for(self, preprocess):
+        family = preprocess_family(preprocess)
+        if family not in self.mappings:
+            raise ValueError(
+                "No mapping net loaded for preprocess '%s', see add_mapping" % preprocess
+            )
+        return self.mappings[family]
+
+    def prepare_source(self, x, preprocess="crop", precision="fp32"):
+        """
+        prepare_animation_source for x, to share between iter_frames calls
+        that render several ranges of the same video.
+        """
+        source_image = x["source_image"].type(torch.FloatTensor).to(self.device)
+        source_semantics = x["source_semantics"].type(torch.FloatTensor)
+        return prepare_animation_source(
+            source_image,
+            source_semantics.to(self.device),
+            self.generator,
+            self.kp_extractor,
+            self.mapping_for(preprocess),
+            precision,
+        )
+
+    def iter_frames(
         self,
         x,
-        video_save_dir,
-        pic_path,
-        crop_info,
-        enhancer=None,
-        background_enhancer=None,
         preprocess="crop",
-        img_size=256,
+        start=0,
+        end=None,
+        precision="fp32",
+        source=None,
+        tuner=None,
+        progress_callback=None,
     ):
+        """
+        Renders frames start..end of x (get_facerender_data output) and yields
+        them chunk by chunk as (n, H, W, 3) uint8 arrays. source (see
+        prepare_source) and tuner (a ChunkTuner) are reused across calls when
+        given; progress_callback is passed to iter_animation.
+        """
+        mapping = self.mapping_for(preprocess)
+        frame_num = x["frame_num"]
+        if end is None:
+            end = frame_num
+
         source_image = x["source_image"].type(torch.FloatTensor)
         source_semantics = x["source_semantics"].type(torch.FloatTensor)
-        target_semantics = x["target_semantics_list"].type(torch.FloatTensor)
+        target_semantics = x["target_semantics"].type(torch.FloatTensor)
         source_image = source_image.to(self.device)
         source_semantics = source_semantics.to(self.device)
         target_semantics = target_semantics.to(self.device)
@@ -241,56 +359,143 @@ class AnimateFromCoeff:
         else:
             roll_c_seq = None
 
-        frame_num = x["frame_num"]
-
-        predictions_video = make_animation(
+        # MappingNet looks semantic_radius frames to each side, the neighbouring
+        # coefficients are passed as context so a range renders exactly like
+        # the same frames of a single pass
+        lo = max(start - MappingNet.semantic_radius, 0)
+        hi = min(end + MappingNet.semantic_radius, frame_num)
+        camera = [
+            None if seq is None else seq[..., lo:hi]
+            for seq in [yaw_c_seq, pitch_c_seq, roll_c_seq]
+        ]
+        predictions = iter_animation(
             source_image,
             source_semantics,
-            target_semantics,
+            target_semantics[..., lo:hi],
             self.generator,
             self.kp_extractor,
             self.he_estimator,
-            self.mapping,
-            yaw_c_seq,
-            pitch_c_seq,
-            roll_c_seq,
+            mapping,
+            *camera,
             use_exp=True,
+            precision=precision,
+            chunk_size=x.get("chunk_size"),
+            context=(start - lo, hi - end),
+            source=source,
+            tuner=tuner,
+            progress_callback=progress_callback,
         )
+        for chunk in predictions:
+            yield to_uint8_frames(chunk)
 
-        predictions_video = predictions_video.reshape(
-            (-1,) + predictions_video.shape[2:]
-        )
-        predictions_video = predictions_video[:frame_num]
+    def generate(
+        self,
+        x,
+        video_save_dir,
+        pic_path,
+        crop_info,
+        enhancer=None,
+        background_enhancer=None,
+        preprocess="crop",
+        img_size=256,
+        return_artifacts=False,
+        temp_dir=None,
+        segment_frames=None,
+        precision="fp32",
+        progress_callback=None,
+    ):
+        """
+        Returns the path of the final video, or with return_artifacts a dict of
+        every video written: 'video' (cropped face), 'full' (pasted back,
+        `full` preprocess only), 'enhanced' (enhancer only) and 'final'.
+        Intermediate files go to temp_dir, which defaults to video_save_dir.
+        With segment_frames, the face video is rendered and encoded in
+        segments of that many frames. precision is passed to iter_animation.
+        progress_callback(fraction) is called after every rendered chunk with
+        the fraction of frames rendered so far; an exception raised from it
+        aborts the rendering.
+        """
+        # the video and audio libraries are only imported once a video is written
+        import cv2
+        import imageio
+        from pydub import AudioSegment
+
+        from ..utils.videoio import concat_videos, save_video_with_watermark
+
+        if temp_dir is None:
+            temp_dir = video_save_dir
 
-        video = []
-        for idx in range(predictions_video.shape[0]):
-            image = predictions_video[idx]
-            image = np.transpose(image.data.cpu().numpy(), [1, 2, 0]).astype(np.float32)
-            video.append(image)
-        result = img_as_ubyte(video)
+        frame_num = x["frame_num"]
+        # the source encoding and the tuned chunk size carry over from one
+        # segment to the next, the tuned size also to later videos
+        source = self.prepare_source(x, preprocess, precision)
+        tuned_key = (x["source_image"].shape[-1], str(self.device), precision)
+        tuner = ChunkTuner(
+            self.device, x.get("chunk_size") or self.chunk_sizes.get(tuned_key)
+        )
+        rendered = 0
+
+        def chunk_rendered(n):
+            nonlocal rendered
+            rendered += n
+            if progress_callback is not None:
+                progress_callback(rendered / frame_num)
+
+        def render(start, end, path):
+            # frames go to the encoder chunk by chunk as they are rendered, so
+            # memory does not grow with the length of the audio
+            writer = imageio.get_writer(path, fps=float(25))
+            try:
+                for frames in self.iter_frames(
+                    x,
+                    preprocess,
+                    start,
+                    end,
+                    precision,
+                    source=source,
+                    tuner=tuner,
+                    progress_callback=chunk_rendered,
+                ):
+                    for frame in frames:
+                        if original_size:
+                            frame = cv2.resize(frame, out_size)
+                        writer.append_data(frame)
+            finally:
+                writer.close()
 
         ### the generated video is 256x256, so we keep the aspect ratio,
         original_size = crop_info[0]
         if original_size:
-            result = [
-                cv2.resize(
-                    result_i,
-                    (img_size, int(img_size * original_size[1] / original_size[0])),
-                )
-                for result_i in result
-            ]
+            out_size = (img_size, int(img_size * original_size[1] / original_size[0]))
 
         video_name = x["video_name"] + ".mp4"
-        path = os.path.join(video_save_dir, "temp_" + video_name)
+        path = os.path.join(temp_dir, "temp_" + video_name)
 
-        imageio.mimsave(path, result, fps=float(25))
+        if not segment_frames or segment_frames >= frame_num:
+            render(0, frame_num, path)
+        else:
+            # long-form mode: every segment is its own file, joined by stream
+            # copy at the end
+            segment_paths = []
+            for start in range(0, frame_num, segment_frames):
+                segment_path = os.path.join(
+                    temp_dir, "temp_%s_%05d.mp4" % (x["video_name"], len(segment_paths))
+                )
+                render(start, min(start + segment_frames, frame_num), segment_path)
+                segment_paths.append(segment_path)
+            concat_videos(segment_paths, path, temp_dir=temp_dir)
+            for segment_path in segment_paths:
+                os.remove(segment_path)
+        if not x.get("chunk_size") and not tuner.tuning:
+            self.chunk_sizes[tuned_key] = tuner.size
 
         av_path = os.path.join(video_save_dir, video_name)
         return_path = av_path
+        artifacts = {"video": av_path}
 
         audio_path = x["audio_path"]
         audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
-        new_audio_path = os.path.join(video_save_dir, audio_name + ".wav")
+        new_audio_path = os.path.join(temp_dir, audio_name + ".wav")
         start_time = 0
         # cog will not keep the .mp3 filename
         sound = AudioSegment.from_file(audio_path)
@@ -300,14 +505,19 @@ class AnimateFromCoeff:
         word = word1[start_time:end_time]
         word.export(new_audio_path, format="wav")
 
-        save_video_with_watermark(path, new_audio_path, av_path, watermark=False)
+        save_video_with_watermark(
+            path, new_audio_path, av_path, watermark=False, temp_dir=temp_dir
+        )
         print(f"The generated video is named {video_save_dir}/{video_name}")
 
         if "full" in preprocess.lower():
+            from ..utils.paste_pic import paste_pic
+
             # only add watermark to the full image.
             video_name_full = x["video_name"] + "_full.mp4"
             full_video_path = os.path.join(video_save_dir, video_name_full)
             return_path = full_video_path
+            artifacts["full"] = full_video_path
             paste_pic(
                 path,
                 pic_path,
@@ -315,6 +525,7 @@ class AnimateFromCoeff:
                 new_audio_path,
                 full_video_path,
                 extended_crop=True if "ext" in preprocess.lower() else False,
+                temp_dir=temp_dir,
             )
             print(f"The generated video is named {video_save_dir}/{video_name_full}")
         else:
@@ -322,10 +533,17 @@ class AnimateFromCoeff:
 
         #### paste back then enhancers
         if enhancer:
+            # gfpgan (and realesrgan) are only imported when an enhancer is used
+            from ..utils.face_enhancer import (
+                enhancer_generator_with_len,
+                enhancer_list,
+            )
+
             video_name_enhancer = x["video_name"] + "_enhanced.mp4"
-            enhanced_path = os.path.join(video_save_dir, "temp_" + video_name_enhancer)
+            enhanced_path = os.path.join(temp_dir, "temp_" + video_name_enhancer)
             av_path_enhancer = os.path.join(video_save_dir, video_name_enhancer)
             return_path = av_path_enhancer
+            artifacts["enhanced"] = av_path_enhancer
 
             try:
                 enhanced_images_gen_with_len = enhancer_generator_with_len(
@@ -343,7 +561,11 @@ class AnimateFromCoeff:
                 )
 
             save_video_with_watermark(
-                enhanced_path, new_audio_path, av_path_enhancer, watermark=False
+                enhanced_path,
+                new_audio_path,
+                av_path_enhancer,
+                watermark=False,
+                temp_dir=temp_dir,
             )
             print(
                 f"The generated video is named {video_save_dir}/{video_name_enhancer}"
@@ -353,4 +575,7 @@ class AnimateFromCoeff:
         os.remove(path)
         os.remove(new_audio_path)
 
+        if return_artifacts:
+            artifacts["final"] = return_path
+            return artifacts
         return return_path
@@ -1,7 +1,7 @@
 from torch import nn
 import torch.nn.functional as F
 import torch
-from ...facerender.modules.util import Hourglass, make_coordinate_grid, kp2gaussian
+from ...facerender.modules.util import Hourglass, cached_coordinate_grid, kp2gaussian
 
 from ...facerender.sync_batchnorm import SynchronizedBatchNorm3d as BatchNorm3d
 
@@ -11,6 +11,8 @@ class DenseMotionNetwork(nn.Module):
     Module that predicting a dense motion from sparse motion representation given by kp_source and kp_driving
     """
 
+    fold_pairs = (("compress", "norm"),)
+
     def __init__(
         self,
         block_expansion,
@@ -48,16 +50,39 @@ class DenseMotionNetwork(nn.Module):
 
         self.num_kp = num_kp
 
-    def create_sparse_motions(self, feature, kp_driving, kp_source):
+    def prepare_source(self, feature, kp_source):
+        """
+        Everything forward needs from the source side only: the compressed
+        feature, the identity grid shifted by the source keypoints and the
+        source heatmap. They are constant for a video, so make_animation
+        computes them once and passes them as source_cache.
+        """
+        feature = self.compress(feature)
+        feature = self.norm(feature)
+        feature = F.relu(feature)
+
         bs, _, d, h, w = feature.shape
-        identity_grid = make_coordinate_grid((d, h, w), type=kp_source["value"].type())
-        identity_grid = identity_grid.view(1, 1, d, h, w, 3)
-        coordinate_grid = identity_grid - kp_driving["value"].view(
-            bs, self.num_kp, 1, 1, 1, 3
-        )
+        kp = kp_source["value"]
+        identity_grid = cached_coordinate_grid((d, h, w), kp).view(1, 1, d, h, w, 3)
+        return {
+            "feature": feature,
+            "identity_grid": identity_grid,
+            "source_grid": identity_grid
+            + kp.view(kp.shape[0], self.num_kp, 1, 1, 1, 3),
+            "gaussian_source": kp2gaussian(
+                kp_source, spatial_size=(d, h, w), kp_variance=0.01
+            ),
+        }
+
+    def create_sparse_motions(self, bs, kp_driving, kp_source, source_cache):
+        identity_grid = source_cache["identity_grid"]
+        _, _, d, h, w, _ = identity_grid.shape
 
         # if 'jacobian' in kp_driving:
         if "jacobian" in kp_driving and kp_driving["jacobian"] is not None:
+            coordinate_grid = identity_grid - kp_driving["value"].view(
+                bs, self.num_kp, 1, 1, 1, 3
+            )
             jacobian = torch.matmul(
                 kp_source["jacobian"], torch.inverse(kp_driving["jacobian"])
             )
@@ -66,12 +91,17 @@ class DenseMotionNetwork(nn.Module):
             coordinate_grid = torch.matmul(jacobian, coordinate_grid.unsqueeze(-1))
             coordinate_grid = coordinate_grid.squeeze(-1)
 
-        driving_to_source = coordinate_grid + kp_source["value"].view(
-            bs, self.num_kp, 1, 1, 1, 3
-        )  # (bs, num_kp, d, h, w, 3)
+            driving_to_source = coordinate_grid + kp_source["value"].view(
+                bs, self.num_kp, 1, 1, 1, 3
+            )  # (bs, num_kp, d, h, w, 3)
+        else:
+            # identity + kp_source is cached, only the driving side is per frame
+            driving_to_source = source_cache["source_grid"] - kp_driving[
+                "value"
+            ].view(bs, self.num_kp, 1, 1, 1, 3)
 
         # adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, 1, d, h, w, 3)
         sparse_motions = torch.cat(
             [identity_grid, driving_to_source], dim=1
         )  # bs num_kp+1 d h w 3
@@ -81,31 +111,30 @@ class DenseMotionNetwork(nn.Module):
         return sparse_motions
 
     def create_deformed_feature(self, feature, sparse_motions):
-        bs, _, d, h, w = feature.shape
-        feature_repeat = (
-            feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp + 1, 1, 1, 1, 1, 1)
-        )  # (bs, num_kp+1, 1, c, d, h, w)
-        feature_repeat = feature_repeat.view(
+        bs = sparse_motions.shape[0]
+        _, c, d, h, w = feature.shape
+        feature_repeat = feature.unsqueeze(1).expand(
+            bs, self.num_kp + 1, c, d, h, w
+        )  # (bs, num_kp+1, c, d, h, w)
+        feature_repeat = feature_repeat.reshape(
             bs * (self.num_kp + 1), -1, d, h, w
         )  # (bs*(num_kp+1), c, d, h, w)
         sparse_motions = sparse_motions.view(
             (bs * (self.num_kp + 1), d, h, w, -1)
         )  # (bs*(num_kp+1), d, h, w, 3) !!!!
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
+        # sampling coordinates stay in fp32 under autocast
+        sparse_deformed = F.grid_sample(feature_repeat.float(), sparse_motions.float())
         sparse_deformed = sparse_deformed.view(
             (bs, self.num_kp + 1, -1, d, h, w)
         )  # (bs, num_kp+1, c, d, h, w)
         return sparse_deformed
 
-    def create_heatmap_representations(self, feature, kp_driving, kp_source):
+    def create_heatmap_representations(self, feature, kp_driving, source_cache):
         spatial_size = feature.shape[3:]
         gaussian_driving = kp2gaussian(
             kp_driving, spatial_size=spatial_size, kp_variance=0.01
         )
-        gaussian_source = kp2gaussian(
-            kp_source, spatial_size=spatial_size, kp_variance=0.01
-        )
-        heatmap = gaussian_driving - gaussian_source
+        heatmap = gaussian_driving - source_cache["gaussian_source"]
 
         # adding background feature
         zeros = torch.zeros(
@@ -115,19 +144,21 @@ class DenseMotionNetwork(nn.Module):
         heatmap = heatmap.unsqueeze(2)  # (bs, num_kp+1, 1, d, h, w)
         return heatmap
 
-    def forward(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape
-
-        feature = self.compress(feature)
-        feature = self.norm(feature)
-        feature = F.relu(feature)
+    def forward(self, feature, kp_driving, kp_source, source_cache=None):
+        if source_cache is None:
+            source_cache = self.prepare_source(feature, kp_source)
+        feature = source_cache["feature"]
+        bs = kp_driving["value"].shape[0]
+        _, _, d, h, w = feature.shape
 
         out_dict = dict()
-        sparse_motion = self.create_sparse_motions(feature, kp_driving, kp_source)
+        sparse_motion = self.create_sparse_motions(
+            bs, kp_driving, kp_source, source_cache
+        )
         deformed_feature = self.create_deformed_feature(feature, sparse_motion)
 
         heatmap = self.create_heatmap_representations(
-            deformed_feature, kp_driving, kp_source
+            deformed_feature, kp_driving, source_cache
         )
 
         input_ = torch.cat([heatmap, deformed_feature], dim=2)
@@ -138,7 +169,7 @@ class DenseMotionNetwork(nn.Module):
         prediction = self.hourglass(input_)
 
         mask = self.mask(prediction)
-        mask = F.softmax(mask, dim=1)
+        mask = F.softmax(mask.float(), dim=1)
         out_dict["mask"] = mask
         mask = mask.unsqueeze(2)  # (bs, num_kp+1, 1, d, h, w)
 
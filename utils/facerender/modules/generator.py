@@ -287,9 +287,15 @@ class OcclusionAwareSPADEGenerator(nn.Module):
             deformation = deformation.permute(0, 4, 1, 2, 3)
             deformation = F.interpolate(deformation, size=(d, h, w), mode="trilinear")
             deformation = deformation.permute(0, 2, 3, 4, 1)
-        return F.grid_sample(inp, deformation)
-
-    def forward(self, source_image, kp_driving, kp_source):
+        # sampling coordinates stay in fp32 under autocast
+        return F.grid_sample(inp.float(), deformation.float())
+
+    def encode_source(self, source_image):
+        """
+        3D feature volume of the source image. It only depends on the source,
+        so renderers compute it once per video and pass it to warp_and_decode
+        for every frame.
+        """
         # Encoding (downsampling) part
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
@@ -298,13 +304,26 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         bs, c, h, w = out.shape
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h, w)
-        feature_3d = self.resblocks_3d(feature_3d)
-
+        return self.resblocks_3d(feature_3d)
+
+    def prepare_source(self, feature_3d, kp_source):
+        """
+        Source-side inputs of the dense motion network, constant for a video;
+        pass the result to warp_and_decode as source_cache.
+        """
+        if self.dense_motion_network is None:
+            return None
+        return self.dense_motion_network.prepare_source(feature_3d, kp_source)
+
+    def warp_and_decode(self, feature_3d, kp_driving, kp_source, source_cache=None):
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
         if self.dense_motion_network is not None:
             dense_motion = self.dense_motion_network(
-                feature=feature_3d, kp_driving=kp_driving, kp_source=kp_source
+                feature=feature_3d,
+                kp_driving=kp_driving,
+                kp_source=kp_source,
+                source_cache=source_cache,
             )
             output_dict["mask"] = dense_motion["mask"]
 
@@ -341,3 +360,7 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         output_dict["prediction"] = out
 
         return output_dict
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.warp_and_decode(feature_3d, kp_driving, kp_source)
@@ -103,7 +103,8 @@ class KPDetector(nn.Module):
 
         final_shape = prediction.shape
         heatmap = prediction.view(final_shape[0], final_shape[1], -1)
-        heatmap = F.softmax(heatmap / self.temperature, dim=2)
+        # fp32 under autocast too, the keypoints are the softmax mean
+        heatmap = F.softmax(heatmap.float() / self.temperature, dim=2)
         heatmap = heatmap.view(*final_shape)
 
         out = self.gaussian2kp(heatmap)
@@ -0,0 +1,71 @@
+import torch
+import torch.nn.functional as F
+
+# (num_bins, dtype, device) -> bin index tensor of headpose_pred_to_degree
+_bin_index_cache = {}
+
+
+def bin_index(num_bins, dtype, device):
+    key = (num_bins, dtype, device)
+    if key not in _bin_index_cache:
+        _bin_index_cache[key] = torch.arange(num_bins, dtype=dtype, device=device)
+    return _bin_index_cache[key]
+
+
+def headpose_pred_to_degree(pred):
+    """ (T, 66) bin logits -> (T,) degrees, in fp32 whatever the logits are """
+    pred = F.softmax(pred.float(), dim=1)
+    index = bin_index(pred.shape[1], pred.dtype, pred.device)
+    return torch.sum(pred * index, 1) * 3 - 99
+
+
+def get_rotation_matrix(yaw, pitch, roll):
+    """
+    (T,) degrees -> (T, 3, 3), the product pitch_mat @ yaw_mat @ roll_mat
+    written out so the whole sequence is one stack.
+    """
+    yaw = yaw / 180 * 3.14
+    pitch = pitch / 180 * 3.14
+    roll = roll / 180 * 3.14
+
+    cy, sy = torch.cos(yaw), torch.sin(yaw)
+    cp, sp = torch.cos(pitch), torch.sin(pitch)
+    cr, sr = torch.cos(roll), torch.sin(roll)
+
+    rot_mat = torch.stack([
+        cy * cr,                  -cy * sr,                  sy,
+        sp * sy * cr + cp * sr,   -sp * sy * sr + cp * cr,   -sp * cy,
+        -cp * sy * cr + sp * sr,  cp * sy * sr + sp * cr,    cp * cy,
+    ], dim=1)
+    return rot_mat.view(-1, 3, 3)
+
+
+def transform_keypoints(kp_canonical, he, yaw_in=None, pitch_in=None, roll_in=None, wo_exp=False):
+    """
+    Driving keypoints of every frame at once.
+
+    kp_canonical -- (1, K, 3) or (T, K, 3) canonical keypoints of the source
+    he           -- MappingNet outputs for T frames (yaw/pitch/roll bins, t, exp)
+    *_in         -- (T,) degrees overriding the predicted pose, e.g. yaw_c_seq
+
+    Returns (T, K, 3) in fp32, run it outside autocast.
+    """
+    yaw = headpose_pred_to_degree(he['yaw']) if yaw_in is None else yaw_in
+    pitch = headpose_pred_to_degree(he['pitch']) if pitch_in is None else pitch_in
+    roll = headpose_pred_to_degree(he['roll']) if roll_in is None else roll_in
+
+    rot_mat = get_rotation_matrix(yaw, pitch, roll)    # (T, 3, 3)
+
+    # keypoint rotation, broadcast over the frames
+    kp_rotated = torch.matmul(kp_canonical, rot_mat.transpose(1, 2))
+
+    # keypoint translation, only along y
+    t = he['t'].float()
+    t = torch.stack([torch.zeros_like(t[:, 1]), t[:, 1], torch.zeros_like(t[:, 1])], dim=1)
+    kp_t = kp_rotated + t.unsqueeze(1)
+
+    # add expression deviation
+    exp = he['exp'].float()
+    if wo_exp:
+        exp = exp * 0
+    return kp_t + exp.view(exp.shape[0], -1, 3)
@@ -1,9 +1,13 @@
+import time
 from scipy.spatial import ConvexHull
 import torch
 import torch.nn.functional as F
 import numpy as np
 from tqdm import tqdm 
 
+from ...facerender.modules.kinematics import transform_keypoints
+from ...utils.precision import autocast_dtype, precision_autocast
+
 def normalize_kp(kp_source, kp_driving, kp_driving_initial, adapt_movement_scale=False,
                  use_relative_movement=False, use_relative_jacobian=False):
     if adapt_movement_scale:
@@ -26,117 +30,182 @@ def normalize_kp(kp_source, kp_driving, kp_driving_initial, adapt_movement_scale
 
     return kp_new
 
-def headpose_pred_to_degree(pred):
-    device = pred.device
-    idx_tensor = [idx for idx in range(66)]
-    idx_tensor = torch.FloatTensor(idx_tensor).type_as(pred).to(device)
-    pred = F.softmax(pred)
-    degree = torch.sum(pred*idx_tensor, 1) * 3 - 99
-    return degree
-
-def get_rotation_matrix(yaw, pitch, roll):
-    yaw = yaw / 180 * 3.14
-    pitch = pitch / 180 * 3.14
-    roll = roll / 180 * 3.14
-
-    roll = roll.unsqueeze(1)
-    pitch = pitch.unsqueeze(1)
-    yaw = yaw.unsqueeze(1)
-
-    pitch_mat = torch.cat([torch.ones_like(pitch), torch.zeros_like(pitch), torch.zeros_like(pitch), 
-                          torch.zeros_like(pitch), torch.cos(pitch), -torch.sin(pitch),
-                          torch.zeros_like(pitch), torch.sin(pitch), torch.cos(pitch)], dim=1)
-    pitch_mat = pitch_mat.view(pitch_mat.shape[0], 3, 3)
-
-    yaw_mat = torch.cat([torch.cos(yaw), torch.zeros_like(yaw), torch.sin(yaw), 
-                           torch.zeros_like(yaw), torch.ones_like(yaw), torch.zeros_like(yaw),
-                           -torch.sin(yaw), torch.zeros_like(yaw), torch.cos(yaw)], dim=1)
-    yaw_mat = yaw_mat.view(yaw_mat.shape[0], 3, 3)
-
-    roll_mat = torch.cat([torch.cos(roll), -torch.sin(roll), torch.zeros_like(roll),  
-                         torch.sin(roll), torch.cos(roll), torch.zeros_like(roll),
-                         torch.zeros_like(roll), torch.zeros_like(roll), torch.ones_like(roll)], dim=1)
-    roll_mat = roll_mat.view(roll_mat.shape[0], 3, 3)
-
-    rot_mat = torch.einsum('bij,bjk,bkm->bim', pitch_mat, yaw_mat, roll_mat)
-
-    return rot_mat
-
 def keypoint_transformation(kp_canonical, he, wo_exp=False):
-    kp = kp_canonical['value']    # (bs, k, 3) 
-    yaw, pitch, roll= he['yaw'], he['pitch'], he['roll']      
-    yaw = headpose_pred_to_degree(yaw) 
-    pitch = headpose_pred_to_degree(pitch)
-    roll = headpose_pred_to_degree(roll)
+    # dict interface of the original per-frame code, see kinematics
+    return {'value': transform_keypoints(kp_canonical['value'], he,
+                                         yaw_in=he.get('yaw_in'), pitch_in=he.get('pitch_in'),
+                                         roll_in=he.get('roll_in'), wo_exp=wo_exp)}
 
-    if 'yaw_in' in he:
-        yaw = he['yaw_in']
-    if 'pitch_in' in he:
-        pitch = he['pitch_in']
-    if 'roll_in' in he:
-        roll = he['roll_in']
 
-    rot_mat = get_rotation_matrix(yaw, pitch, roll)    # (bs, 3, 3)
-
-    t, exp = he['t'], he['exp']
-    if wo_exp:
-        exp =  exp*0  
-    
-    # keypoint rotation
-    kp_rotated = torch.einsum('bmp,bkp->bkm', rot_mat, kp)
-
-    # keypoint translation
-    t[:, 0] = t[:, 0]*0
-    t[:, 2] = t[:, 2]*0
-    t = t.unsqueeze(1).repeat(1, kp.shape[1], 1)
-    kp_t = kp_rotated + t
+class ChunkTuner:
+    """
+    Picks how many consecutive frames go into one generator call. A fixed
+    chunk_size is used as is. Otherwise, on CUDA the first single-frame call
+    measures the peak memory per frame and the chunk is sized to the free
+    memory; on CPU chunk sizes 1, 2, 4, ... are timed until frames per second
+    stop improving, the timing of the first (cold) call is discarded. Probe
+    calls render real frames, nothing is rendered twice.
+    """
 
-    # add expression deviation 
-    exp = exp.view(exp.shape[0], -1, 3)
-    kp_transformed = kp_t + exp
+    def __init__(self, device, chunk_size=None, max_chunk=32, memory_fraction=0.7, min_gain=1.1):
+        self.device = torch.device(device)
+        self.max_chunk = max_chunk
+        self.memory_fraction = memory_fraction
+        self.min_gain = min_gain
+        self.tuning = not chunk_size
+        self.size = chunk_size or 1
+        self.best_size, self.best_fps = 1, 0.
+        self.warmed_up = self.device.type == 'cuda'
+
+    def start(self):
+        if not self.tuning:
+            return
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.base_memory = torch.cuda.memory_allocated(self.device)
+        self.start_time = time.time()
+
+    def stop(self, num_frames):
+        if not self.tuning:
+            return
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            per_frame = (torch.cuda.max_memory_allocated(self.device) - self.base_memory) / num_frames
+            free, _ = torch.cuda.mem_get_info(self.device)
+            self.size = int(free * self.memory_fraction / max(per_frame, 1))
+            self.finish(max(1, min(self.size, self.max_chunk)))
+            return
+
+        if not self.warmed_up:
+            # allocator and kernel warm-up, the same size is timed again
+            self.warmed_up = True
+            return
+        fps = num_frames / max(time.time() - self.start_time, 1e-6)
+        improved = fps > self.best_fps * self.min_gain
+        if fps > self.best_fps:
+            self.best_size, self.best_fps = self.size, fps
+        if improved and self.size * 2 <= self.max_chunk:
+            self.size *= 2
+        else:
+            self.finish(self.best_size)
+
+    def finish(self, size):
+        self.size = size
+        self.tuning = False
+        print('Face Renderer: %d frames per generator call' % size)
+
+
+@torch.no_grad()
+def prepare_animation_source(source_image, source_semantics, generator, kp_detector, mapping,
+                             precision='fp32'):
+    """
+    The source side of iter_animation: canonical and source keypoints, the
+    source feature volume and the dense motion cache. It is the same for
+    every frame of a video, renders of several ranges compute it once.
+    """
+    dtype = autocast_dtype(precision, source_image.device)
 
-    return {'value': kp_transformed}
+    source_image = source_image[:1]
+    with precision_autocast(dtype, source_image.device):
+        kp_canonical = kp_detector(source_image)
+        he_source = mapping(source_semantics[:1])
+    kp_source = keypoint_transformation(kp_canonical, he_source)
+    with precision_autocast(dtype, source_image.device):
+        source_feature = generator.encode_source(source_image)
+        source_cache = generator.prepare_source(source_feature, kp_source)
+    return {'kp_canonical': kp_canonical, 'kp_source': kp_source,
+            'source_feature': source_feature, 'source_cache': source_cache}
+
+
+@torch.no_grad()
+def iter_animation(source_image, source_semantics, target_semantics,
+                   generator, kp_detector, he_estimator, mapping,
+                   yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
+                   use_exp=True, precision='fp32', chunk_size=None, context=(0, 0),
+                   source=None, tuner=None, progress_callback=None):
+    """
+    Renders the coefficient sequence target_semantics (bs, coeff_nc, frame_num)
+    as one stream, chunk_size consecutive frames per generator call (picked by
+    ChunkTuner when None). The source is the first item of the batch.
+    Yields the predictions of each chunk, (n, 3, H, W) in [0, 1], so callers
+    can write frames out and only ever hold one chunk.
+
+    context   -- (before, after) frames at the ends of target_semantics (and
+                 the camera sequences) that only feed the MappingNet windows of
+                 their neighbours and are not rendered, for segment rendering
+    precision -- 'fp32', 'bf16' or 'fp16', see utils.precision. The networks
+                 run under autocast, the keypoint math between them in fp32.
+    source    -- prepare_animation_source output, computed here when None
+    tuner     -- a ChunkTuner carried over from the previous range, so its
+                 chunk size is probed once per video; chunk_size is then unused
+    progress_callback -- called with the number of frames of every rendered
+                 chunk; an exception raised from it stops the rendering
+    """
+    dtype = autocast_dtype(precision, source_image.device)
+
+    if source is None:
+        source = prepare_animation_source(source_image, source_semantics, generator, kp_detector,
+                                          mapping, precision)
+    kp_canonical, kp_source = source['kp_canonical'], source['kp_source']
+    source_feature, source_cache = source['source_feature'], source['source_cache']
+
+    bs, _, frame_num = target_semantics.shape
+    # poses and keypoints of every frame in one pass, the render loop only
+    # runs the generator
+    with precision_autocast(dtype, source_image.device):
+        he_driving = mapping.forward_sequence(target_semantics)
+    camera = [None if seq is None else seq.reshape(-1) for seq in [yaw_c_seq, pitch_c_seq, roll_c_seq]]
+    kp_driving_all = transform_keypoints(kp_canonical['value'], he_driving, *camera)
+    kp_driving_all = kp_driving_all[context[0]:kp_driving_all.shape[0] - context[1]]
+
+    if tuner is None:
+        tuner = ChunkTuner(source_image.device, chunk_size)
+    total = kp_driving_all.shape[0]
+    start = 0
+    with tqdm(total=total, desc='Face Renderer:') as pbar:
+        while start < total:
+            # the last chunk is just shorter, no padded frames are rendered
+            end = min(start + tuner.size, total)
+            n = end - start
+            tuner.start()
+
+            kp_driving = {'value': kp_driving_all[start:end]}
+            kp_source_chunk = {'value': kp_source['value'].expand(n, -1, -1)}
+            feature_chunk = source_feature.expand((n,) + source_feature.shape[1:])
 
+            kp_norm = kp_driving
+            with precision_autocast(dtype, source_image.device):
+                out = generator.warp_and_decode(feature_chunk, kp_source=kp_source_chunk, kp_driving=kp_norm,
+                                                source_cache=source_cache)
+            tuner.stop(n)
+            pbar.update(n)
+            if progress_callback is not None:
+                progress_callback(n)
+            start = end
+            yield out['prediction'].float()
 
 
 def make_animation(source_image, source_semantics, target_semantics,
                             generator, kp_detector, he_estimator, mapping, 
                             yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
-                            use_exp=True, use_half=False):
-    with torch.no_grad():
-        predictions = []
+                            use_exp=True, precision='fp32', chunk_size=None):
+    """ iter_animation collected into one (bs, frame_num, 3, H, W) tensor """
+    bs, _, frame_num = target_semantics.shape
+    predictions_ts = torch.cat(list(iter_animation(
+        source_image, source_semantics, target_semantics, generator, kp_detector, he_estimator, mapping,
+        yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp=use_exp, precision=precision, chunk_size=chunk_size)), dim=0)
+    return predictions_ts.reshape((bs, frame_num) + predictions_ts.shape[1:])
 
-        kp_canonical = kp_detector(source_image)
-        he_source = mapping(source_semantics)
-        kp_source = keypoint_transformation(kp_canonical, he_source)
-    
-        for frame_idx in tqdm(range(target_semantics.shape[1]), 'Face Renderer:'):
-            # still check the dimension
-            # print(target_semantics.shape, source_semantics.shape)
-            target_semantics_frame = target_semantics[:, frame_idx]
-            he_driving = mapping(target_semantics_frame)
-            if yaw_c_seq is not None:
-                he_driving['yaw_in'] = yaw_c_seq[:, frame_idx]
-            if pitch_c_seq is not None:
-                he_driving['pitch_in'] = pitch_c_seq[:, frame_idx] 
-            if roll_c_seq is not None:
-                he_driving['roll_in'] = roll_c_seq[:, frame_idx] 
-            
-            kp_driving = keypoint_transformation(kp_canonical, he_driving)
-                
-            kp_norm = kp_driving
-            out = generator(source_image, kp_source=kp_source, kp_driving=kp_norm)
-            '''
-            source_image_new = out['prediction'].squeeze(1)
-            kp_canonical_new =  kp_detector(source_image_new)
-            he_source_new = he_estimator(source_image_new) 
-            kp_source_new = keypoint_transformation(kp_canonical_new, he_source_new, wo_exp=True)
-            kp_driving_new = keypoint_transformation(kp_canonical_new, he_driving, wo_exp=True)
-            out = generator(source_image_new, kp_source=kp_source_new, kp_driving=kp_driving_new)
-            '''
-            predictions.append(out['prediction'])
-        predictions_ts = torch.stack(predictions, dim=1)
-    return predictions_ts
+
+def to_uint8_frames(predictions):
+    """
+    (n, 3, H, W) predictions in [0, 1] -> (n, H, W, 3) uint8 numpy frames,
+    rounded like skimage's img_as_ubyte. The conversion runs on the device of
+    predictions, only the uint8 frames are copied to the host.
+    """
+    frames = (predictions.clamp(0, 1) * 255).round().to(torch.uint8)
+    return frames.permute(0, 2, 3, 1).cpu().numpy()
 
 class AnimateModel(torch.nn.Module):
     """
@@ -6,6 +6,9 @@ import torch.nn.functional as F
 
 
 class MappingNet(nn.Module):
+    # frames looked at on each side of the driven frame
+    semantic_radius = 13
+
     def __init__(self, coeff_nc, descriptor_nc, layer, num_kp, num_bins):
         super( MappingNet, self).__init__()
 
@@ -38,6 +41,31 @@ class MappingNet(nn.Module):
         out = out.view(out.shape[0], -1)
         #print('out:', out.shape)
 
+        return self.decode_descriptor(out)
+
+    def forward_sequence(self, coeff_seq, semantic_radius=None):
+        """
+        Same outputs as `forward` on the (2*semantic_radius+1)-frame window of
+        every frame, windows clamped at the ends of the sequence (see
+        transform_semantic_target), but the convolutions run once over the
+        whole sequence. coeff_seq is (bs, coeff_nc, T), outputs are (bs*T, ...).
+        """
+        if semantic_radius is None:
+            semantic_radius = self.semantic_radius
+        bs, _, num_frames = coeff_seq.shape
+        out = F.pad(coeff_seq, (semantic_radius, semantic_radius), mode='replicate')
+        out = self.first(out)
+        for i in range(self.layer):
+            model = getattr(self, 'encoder' + str(i))
+            out = model(out) + out[:,:,3:-3]
+        # each frame's window is what is left of 2*semantic_radius+1 inputs
+        # after the convolutions, averaging it replaces the adaptive pooling
+        out = F.avg_pool1d(out, kernel_size=out.shape[-1] - num_frames + 1, stride=1)
+        out = out.permute(0, 2, 1).reshape(bs * num_frames, -1)
+
+        return self.decode_descriptor(out)
+
+    def decode_descriptor(self, out):
         yaw = self.fc_yaw(out)
         pitch = self.fc_pitch(out)
         roll = self.fc_roll(out)
@@ -15,12 +15,11 @@ def kp2gaussian(kp, spatial_size, kp_variance):
     """
     mean = kp["value"]
 
-    coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
+    coordinate_grid = cached_coordinate_grid(spatial_size, mean)
     number_of_leading_dimensions = len(mean.shape) - 1
     shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
+    # broadcast against the keypoints instead of repeating the grid for each
     coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
 
     # Preprocess kp shape
     shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
@@ -71,7 +70,33 @@ def make_coordinate_grid(spatial_size, type):
     return meshed
 
 
+# (spatial_size, dtype, device) -> grid built by make_coordinate_grid
+_coordinate_grid_cache = {}
+
+
+def cached_coordinate_grid(spatial_size, ref):
+    """
+    make_coordinate_grid(spatial_size) with the dtype and device of ref, built
+    once per key. The grid is shared, callers must not modify it in place.
+    """
+    key = (tuple(spatial_size), ref.dtype, ref.device)
+    if key not in _coordinate_grid_cache:
+        _coordinate_grid_cache[key] = make_coordinate_grid(
+            spatial_size, ref.type()
+        ).to(ref.device)
+    return _coordinate_grid_cache[key]
+
+
 class ResBottleneck(nn.Module):
+    # (conv, norm) attribute pairs where the norm directly follows the conv,
+    # inference_build.fold_batchnorm merges them for inference
+    fold_pairs = (
+        ("conv1", "norm1"),
+        ("conv2", "norm2"),
+        ("conv3", "norm3"),
+        ("skip", "norm4"),
+    )
+
     def __init__(self, in_features, stride):
         super(ResBottleneck, self).__init__()
         self.conv1 = nn.Conv2d(
@@ -189,6 +214,8 @@ class UpBlock2d(nn.Module):
     Upsampling block for use in decoder.
     """
 
+    fold_pairs = (("conv", "norm"),)
+
     def __init__(self, in_features, out_features, kernel_size=3, padding=1, groups=1):
         super(UpBlock2d, self).__init__()
 
@@ -214,6 +241,8 @@ class UpBlock3d(nn.Module):
     Upsampling block for use in decoder.
     """
 
+    fold_pairs = (("conv", "norm"),)
+
     def __init__(self, in_features, out_features, kernel_size=3, padding=1, groups=1):
         super(UpBlock3d, self).__init__()
 
@@ -240,6 +269,8 @@ class DownBlock2d(nn.Module):
     Downsampling block for use in encoder.
     """
 
+    fold_pairs = (("conv", "norm"),)
+
     def __init__(self, in_features, out_features, kernel_size=3, padding=1, groups=1):
         super(DownBlock2d, self).__init__()
         self.conv = nn.Conv2d(
@@ -265,6 +296,8 @@ class DownBlock3d(nn.Module):
     Downsampling block for use in encoder.
     """
 
+    fold_pairs = (("conv", "norm"),)
+
     def __init__(self, in_features, out_features, kernel_size=3, padding=1, groups=1):
         super(DownBlock3d, self).__init__()
         """
@@ -294,6 +327,8 @@ class SameBlock2d(nn.Module):
     Simple block, preserve spatial resolution.
     """
 
+    fold_pairs = (("conv", "norm"),)
+
     def __init__(
         self, in_features, out_features, groups=1, kernel_size=3, padding=1, lrelu=False
     ):
@@ -352,6 +387,8 @@ class Decoder(nn.Module):
     Hourglass Decoder
     """
 
+    fold_pairs = (("conv", "norm"),)
+
     def __init__(self, block_expansion, in_features, num_blocks=3, max_features=256):
         super(Decoder, self).__init__()
 
@@ -527,7 +564,8 @@ class SPADE(nn.Module):
         self.mlp_beta = nn.Conv2d(nhidden, norm_nc, kernel_size=3, padding=1)
 
     def forward(self, x, segmap):
-        normalized = self.param_free_norm(x)
+        # the instance norm statistics stay in fp32 under autocast
+        normalized = self.param_free_norm(x.float())
         segmap = F.interpolate(segmap, size=x.size()[2:], mode="nearest")
         actv = self.mlp_shared(segmap)
         gamma = self.mlp_gamma(actv)
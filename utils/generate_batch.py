@@ -1,6 +1,5 @@
 import os
 
-from tqdm import tqdm
 import torch
 import numpy as np
 import random
@@ -71,6 +70,21 @@ def generate_blink_seq_randomly(num_frames):
     return ratio
 
 
+def mel_windows(spec, num_frames, fps=25, step_size=16):
+    """
+    The syncnet mel window of every video frame at once: frame i covers the
+    step_size mel steps from 80 * (i - 2) / fps, clamped to the spectrogram.
+    spec is (mel steps, 80); returns (num_frames, 80, step_size) float32.
+    """
+    frame_ids = np.arange(num_frames) - 2
+    # astype(int) truncates toward zero like int()
+    starts = (80.0 * (frame_ids / float(fps))).astype(int)
+    index = starts[:, None] + np.arange(step_size)[None, :]
+    index = np.clip(index, 0, spec.shape[0] - 1)
+    windows = spec.astype(np.float32, copy=False)[index]  # T step_size 80
+    return np.ascontiguousarray(windows.transpose(0, 2, 1))
+
+
 def get_data(
     first_coeff_path,
     audio_path,
@@ -89,24 +103,13 @@ def get_data(
 
     if idlemode:
         num_frames = int(length_of_audio * 25)
-        indiv_mels = np.zeros((num_frames, 80, 16))
+        indiv_mels = np.zeros((num_frames, 80, syncnet_mel_step_size), np.float32)
     else:
         wav = audio.load_wav(audio_path, 16000)
         wav_length, num_frames = parse_audio_length(len(wav), 16000, 25)
         wav = crop_pad_audio(wav, wav_length)
-        orig_mel = audio.melspectrogram(wav).T
-        spec = orig_mel.copy()  # nframes 80
-        indiv_mels = []
-
-        for i in tqdm(range(num_frames), "mel:"):
-            start_frame_num = i - 2
-            start_idx = int(80.0 * (start_frame_num / float(fps)))
-            end_idx = start_idx + syncnet_mel_step_size
-            seq = list(range(start_idx, end_idx))
-            seq = [min(max(item, 0), orig_mel.shape[0] - 1) for item in seq]
-            m = spec[seq, :]
-            indiv_mels.append(m.T)
-        indiv_mels = np.asarray(indiv_mels)  # T 80 16
+        orig_mel = audio.melspectrogram(wav).T  # nframes 80
+        indiv_mels = mel_windows(orig_mel, num_frames, fps, syncnet_mel_step_size)
 
     ratio = generate_blink_seq_randomly(num_frames)  # T
     source_semantics_path = first_coeff_path
@@ -129,7 +132,7 @@ def get_data(
 
         ref_coeff[:, :64] = refeyeblink_coeff[:num_frames, :64]
 
-    indiv_mels = torch.FloatTensor(indiv_mels).unsqueeze(1).unsqueeze(0)  # bs T 1 80 16
+    indiv_mels = torch.from_numpy(indiv_mels).unsqueeze(1).unsqueeze(0)  # bs T 1 80 16
 
     if use_blink:
         ratio = torch.FloatTensor(ratio).unsqueeze(0)  # bs T
@@ -5,11 +5,13 @@ from skimage import io, img_as_float32, transform
 import torch
 import scipy.io as scio
 
+from .facerender.modules.mapping import MappingNet
+
 def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path, 
                         batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None, 
                         expression_scale=1.0, still_mode = False, preprocess='crop', size = 256):
 
-    semantic_radius = 13
+    semantic_radius = MappingNet.semantic_radius
     video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
     txt_path = os.path.splitext(coeff_path)[0]
 
@@ -21,7 +23,6 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
     source_image = transform.resize(source_image, (size, size, 3))
     source_image = source_image.transpose((2, 0, 1))
     source_image_ts = torch.FloatTensor(source_image).unsqueeze(0)
-    source_image_ts = source_image_ts.repeat(batch_size, 1, 1, 1)
     data['source_image'] = source_image_ts
  
     source_semantics_dict = scio.loadmat(first_coeff_path)
@@ -37,7 +38,6 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
 
     source_semantics_new = transform_semantic_1(source_semantics, semantic_radius)
     source_semantics_ts = torch.FloatTensor(source_semantics_new).unsqueeze(0)
-    source_semantics_ts = source_semantics_ts.repeat(batch_size, 1, 1)
     data['source_semantics'] = source_semantics_ts
 
     # target 
@@ -55,32 +55,27 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
                 f.write(str(i)[:7]   + '  '+'\t')
             f.write('\n')
 
-    target_semantics_list = [] 
     frame_num = generated_3dmm.shape[0]
     data['frame_num'] = frame_num
-    for frame_idx in range(frame_num):
-        target_semantics = transform_semantic_target(generated_3dmm, frame_idx, semantic_radius)
-        target_semantics_list.append(target_semantics)
-
-    remainder = frame_num%batch_size
-    if remainder!=0:
-        for _ in range(batch_size-remainder):
-            target_semantics_list.append(target_semantics)
 
-    target_semantics_np = np.array(target_semantics_list)             #frame_num 70 semantic_radius*2+1
-    target_semantics_np = target_semantics_np.reshape(batch_size, -1, target_semantics_np.shape[-2], target_semantics_np.shape[-1])
-    data['target_semantics_list'] = torch.FloatTensor(target_semantics_np)
+    # the whole coefficient sequence, MappingNet.forward_sequence builds the
+    # per-frame windows of transform_semantic_target itself. make_animation
+    # renders it in chunks of batch_size frames (0 or None: picked
+    # automatically), so nothing is padded
+    target_semantics_np = generated_3dmm.transpose(1, 0)[None]        #1 70 frame_num
+    data['target_semantics'] = torch.FloatTensor(target_semantics_np)
+    data['chunk_size'] = batch_size or None
     data['video_name'] = video_name
     data['audio_path'] = audio_path
     
     if input_yaw_list is not None:
-        yaw_c_seq = gen_camera_pose(input_yaw_list, frame_num, batch_size)
+        yaw_c_seq = gen_camera_pose(input_yaw_list, frame_num, 1)
         data['yaw_c_seq'] = torch.FloatTensor(yaw_c_seq)
     if input_pitch_list is not None:
-        pitch_c_seq = gen_camera_pose(input_pitch_list, frame_num, batch_size)
+        pitch_c_seq = gen_camera_pose(input_pitch_list, frame_num, 1)
         data['pitch_c_seq'] = torch.FloatTensor(pitch_c_seq)
     if input_roll_list is not None:
-        roll_c_seq = gen_camera_pose(input_roll_list, frame_num, batch_size) 
+        roll_c_seq = gen_camera_pose(input_roll_list, frame_num, 1) 
         data['roll_c_seq'] = torch.FloatTensor(roll_c_seq)
  
     return data
@@ -5,18 +5,45 @@ import shutil
 import time
 import random
 import string
-from pydub import AudioSegment
-from .utils.preprocess import CropAndExtract
-from .test_audio2coeff import Audio2Coeff
-from .facerender.animate import AnimateFromCoeff
-from .generate_batch import get_data
-from .generate_facerender_batch import get_facerender_data
-from .utils.init_path import init_path
+from .model_registry import ModelRegistry
+from .utils.workspace import JobWorkspace
+
+
+class StageTimer:
+    """
+    Wall time of consecutive pipeline stages: each call to `start` closes the
+    stage that was running.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.stage = None
+        self.begin = time.time()
+        self.stage_begin = self.begin
+
+    def start(self, stage):
+        now = time.time()
+        if self.stage is not None:
+            self.timings[self.stage] = round(now - self.stage_begin, 3)
+        self.stage = stage
+        self.stage_begin = now
+
+    def stop(self):
+        self.start(None)
+        self.timings["total"] = round(time.time() - self.begin, 3)
+        return self.timings
 
 
 class SadTalker:
     def __init__(
-        self, checkpoint_path="checkpoints", config_path="config", lazy_load=False
+        self,
+        checkpoint_path="checkpoints",
+        config_path="config",
+        lazy_load=False,
+        max_cached_models=2,
+        memory_budget_mb=None,
+        workspace_root=None,
+        use_tmpfs=False,
     ):
         if torch.cuda.is_available():
             device = "cuda"
@@ -29,9 +56,26 @@ class SadTalker:
 
         self.checkpoint_path = checkpoint_path
         self.config_path = config_path
+        # where per-job scratch workspaces are created, see JobWorkspace
+        self.workspace_root = workspace_root
+        self.use_tmpfs = use_tmpfs
+
+        # warm models are kept across calls of `test`, see ModelRegistry.
+        self.models = ModelRegistry(
+            checkpoint_path,
+            config_path,
+            device,
+            max_models=max_cached_models,
+            memory_budget_mb=memory_budget_mb,
+        )
+        if not lazy_load:
+            # eager warm-up of the default configuration
+            self.models.get(256, "crop")
 
     @staticmethod
     def mp3_to_wav(mp3_filename, wav_filename, frame_rate):
+        from pydub import AudioSegment
+
         mp3_file = AudioSegment.from_file(file=mp3_filename)
         mp3_file.set_frame_rate(frame_rate).export(wav_filename, format="wav")
 
@@ -42,7 +86,7 @@ class SadTalker:
         preprocess="crop",
         still_mode=False,
         use_enhancer=False,
-        batch_size=1,
+        batch_size=0,
         size=256,
         pose_style=0,
         exp_scale=1.0,
@@ -53,167 +97,252 @@ class SadTalker:
         length_of_audio=0,
         use_blink=True,
         result_dir="./results/",
+        progress_callback=None,
+        segment_frames=0,
+        precision="fp32",
+        silence_db=None,
     ):
-        self.sadtalker_paths = init_path(
-            self.checkpoint_path, self.config_path, size, False, preprocess
-        )
-        print(self.sadtalker_paths)
+        """
+        Returns a dict with
+            job_id     -- name of the job directory
+            workspace  -- directory holding the output videos of the job
+            video_path -- the final video
+            artifacts  -- every video written, see AnimateFromCoeff.generate
+            styles     -- pose style -> artifacts, one entry per rendered style
+            timings    -- seconds spent per stage, plus 'total'
 
-        self.audio_to_coeff = Audio2Coeff(self.sadtalker_paths, self.device)
-        self.preprocess_model = CropAndExtract(self.sadtalker_paths, self.device)
-        self.animate_from_coeff = AnimateFromCoeff(self.sadtalker_paths, self.device)
+        pose_style may be a list: the audio models then run once and one video
+        is rendered per style; video_path and artifacts are those of the first.
+
+        segment_frames > 0 renders and encodes the face video in segments of
+        that many frames, for long audio. precision ('fp32', 'bf16' or 'fp16')
+        applies to the audio models and the face renderer, see utils.precision.
+        silence_db lets the audio models treat near-silent spans as silence,
+        see Audio2Coeff.generate_styles.
+
+        progress_callback(stage, fraction) is called when each stage starts,
+        after every rendered chunk with ("render", fraction) and once more with
+        ("done", 1.0). An exception raised from the callback aborts the job,
+        which is how callers cancel a running job; the final ("done", 1.0) call
+        comes after the videos are written, so it is no place to cancel.
+        """
+        timer = StageTimer()
+
+        def progress(stage, fraction):
+            timer.start(stage)
+            if progress_callback is not None:
+                progress_callback(stage, fraction)
+
+        progress("load_models", 0.0)
+        models = self.models.get(size, preprocess)
+        sadtalker_paths = models["paths"]
+        print(sadtalker_paths)
+
+        audio_to_coeff = models["audio_to_coeff"]
+        preprocess_model = models["preprocess_model"]
+        animate_from_coeff = models["animate_from_coeff"]
 
         # time_tag = str(uuid.uuid4())
         # save_dir = os.path.join(result_dir, time_tag)
         # os.makedirs(save_dir, exist_ok=True)
         # 短いランダムなフォルダ名を生成
         time_tag = time.strftime("%Y%m%d%H%M") + "".join(
-            random.choices(string.ascii_lowercase + string.digits, k=3)
+            random.choices(string.ascii_lowercase + string.digits, k=6)
         )
         save_dir = os.path.join(result_dir, time_tag)
-        os.makedirs(save_dir, exist_ok=True)
 
-        input_dir = os.path.join(save_dir, "input")
-        os.makedirs(input_dir, exist_ok=True)
+        # every intermediate file lives in the job's scratch workspace, which is
+        # removed however the job ends; only the videos are written to save_dir.
+        with JobWorkspace(
+            self.workspace_root, use_tmpfs=self.use_tmpfs, prefix=time_tag + "_"
+        ) as workspace:
+            input_dir = workspace.subdir("input")
 
-        print(source_image)
-        # Gradioが作成した一時ファイルを移動(move)するのではなく、コピー(copy)して使用します。
-        # これにより、Gradioのファイル管理との競合を防ぎます。
-        pic_path = os.path.join(input_dir, os.path.basename(source_image))
-        shutil.copy(source_image, pic_path)
+            print(source_image)
+            # Gradioが作成した一時ファイルを移動(move)するのではなく、コピー(copy)して使用します。
+            # これにより、Gradioのファイル管理との競合を防ぎます。
+            pic_path = os.path.join(input_dir, os.path.basename(source_image))
+            shutil.copy(source_image, pic_path)
 
-        if driven_audio is not None and os.path.isfile(driven_audio):
-            audio_path = os.path.join(input_dir, os.path.basename(driven_audio))
+            if driven_audio is not None and os.path.isfile(driven_audio):
+                audio_path = os.path.join(input_dir, os.path.basename(driven_audio))
 
-            #### mp3 to wav
-            if ".mp3" in audio_path:
-                self.mp3_to_wav(driven_audio, audio_path.replace(".mp3", ".wav"), 16000)
-                audio_path = audio_path.replace(".mp3", ".wav")
-            else:
-                shutil.copy(driven_audio, audio_path)
+                #### mp3 to wav
+                if ".mp3" in audio_path:
+                    self.mp3_to_wav(
+                        driven_audio, audio_path.replace(".mp3", ".wav"), 16000
+                    )
+                    audio_path = audio_path.replace(".mp3", ".wav")
+                else:
+                    shutil.copy(driven_audio, audio_path)
 
-        elif use_idle_mode:
-            audio_path = os.path.join(
-                input_dir, "idlemode_" + str(length_of_audio) + ".wav"
-            )  ## generate audio from this new audio_path
+            elif use_idle_mode:
+                from pydub import AudioSegment
 
-            one_sec_segment = AudioSegment.silent(
-                duration=1000 * length_of_audio
-            )  # duration in milliseconds
-            one_sec_segment.export(audio_path, format="wav")
-        else:
-            print(use_ref_video, ref_info)
-            assert use_ref_video == True and ref_info == "all"
-
-        if use_ref_video and ref_info == "all":
-            # ビデオ名から拡張子を除去し、オーディオファイル名を作成
-            ref_video_videoname = os.path.splitext(os.path.basename(ref_video))[0]
-            audio_filename = ref_video_videoname + "_audio.wav"
-            audio_path = os.path.join(save_dir, audio_filename)
-            print("new audiopath:", audio_path)
-
-            # FFmpeg コマンドを更新（入力と出力が異なることを確認）
-            cmd = r"ffmpeg -y -hide_banner -loglevel error -i %s %s" % (
-                ref_video,
-                audio_path,
-            )
-            os.system(cmd)
+                audio_path = os.path.join(
+                    input_dir, "idlemode_" + str(length_of_audio) + ".wav"
+                )  ## generate audio from this new audio_path
 
-        os.makedirs(save_dir, exist_ok=True)
+                one_sec_segment = AudioSegment.silent(
+                    duration=1000 * length_of_audio
+                )  # duration in milliseconds
+                one_sec_segment.export(audio_path, format="wav")
+            else:
+                print(use_ref_video, ref_info)
+                assert use_ref_video == True and ref_info == "all"
 
-        # crop image and extract 3dmm from image
-        first_frame_dir = os.path.join(save_dir, "first_frame_dir")
-        os.makedirs(first_frame_dir, exist_ok=True)
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(
-            pic_path, first_frame_dir, preprocess, True, size
-        )
+            if use_ref_video and ref_info == "all":
+                # ビデオ名から拡張子を除去し、オーディオファイル名を作成
+                ref_video_videoname = os.path.splitext(os.path.basename(ref_video))[0]
+                audio_filename = ref_video_videoname + "_audio.wav"
+                audio_path = os.path.join(workspace.path, audio_filename)
+                print("new audiopath:", audio_path)
 
-        if first_coeff_path is None:
-            raise AttributeError("No face is detected")
-
-        if use_ref_video:
-            print("using ref video for genreation")
-            ref_video_videoname = os.path.splitext(os.path.split(ref_video)[-1])[0]
-            ref_video_frame_dir = os.path.join(save_dir, ref_video_videoname)
-            os.makedirs(ref_video_frame_dir, exist_ok=True)
-            print("3DMM Extraction for the reference video providing pose")
-            ref_video_coeff_path, _, _ = self.preprocess_model.generate(
-                ref_video, ref_video_frame_dir, preprocess, source_image_flag=False
+                # FFmpeg コマンドを更新（入力と出力が異なることを確認）
+                cmd = r"ffmpeg -y -hide_banner -loglevel error -i %s %s" % (
+                    ref_video,
+                    audio_path,
+                )
+                os.system(cmd)
+
+            # crop image and extract 3dmm from image
+            progress("preprocess", 0.1)
+            first_frame_dir = workspace.subdir("first_frame_dir")
+            first_coeff_path, crop_pic_path, crop_info = preprocess_model.generate(
+                pic_path, first_frame_dir, preprocess, True, size
             )
-        else:
-            ref_video_coeff_path = None
 
-        if use_ref_video:
-            if ref_info == "pose":
-                ref_pose_coeff_path = ref_video_coeff_path
-                ref_eyeblink_coeff_path = None
-            elif ref_info == "blink":
-                ref_pose_coeff_path = None
-                ref_eyeblink_coeff_path = ref_video_coeff_path
-            elif ref_info == "pose+blink":
-                ref_pose_coeff_path = ref_video_coeff_path
-                ref_eyeblink_coeff_path = ref_video_coeff_path
-            elif ref_info == "all":
+            if first_coeff_path is None:
+                raise AttributeError("No face is detected")
+
+            if use_ref_video:
+                print("using ref video for genreation")
+                ref_video_videoname = os.path.splitext(os.path.split(ref_video)[-1])[0]
+                ref_video_frame_dir = workspace.subdir(ref_video_videoname)
+                print("3DMM Extraction for the reference video providing pose")
+                ref_video_coeff_path, _, _ = preprocess_model.generate(
+                    ref_video, ref_video_frame_dir, preprocess, source_image_flag=False
+                )
+            else:
+                ref_video_coeff_path = None
+
+            if use_ref_video:
+                if ref_info == "pose":
+                    ref_pose_coeff_path = ref_video_coeff_path
+                    ref_eyeblink_coeff_path = None
+                elif ref_info == "blink":
+                    ref_pose_coeff_path = None
+                    ref_eyeblink_coeff_path = ref_video_coeff_path
+                elif ref_info == "pose+blink":
+                    ref_pose_coeff_path = ref_video_coeff_path
+                    ref_eyeblink_coeff_path = ref_video_coeff_path
+                elif ref_info == "all":
+                    ref_pose_coeff_path = None
+                    ref_eyeblink_coeff_path = None
+                else:
+                    raise ("error in refinfo")
+            else:
                 ref_pose_coeff_path = None
                 ref_eyeblink_coeff_path = None
+
+            # audio2ceoff
+            progress("audio2coeff", 0.3)
+            if isinstance(pose_style, (list, tuple)):
+                pose_styles = list(dict.fromkeys(pose_style))
             else:
-                raise ("error in refinfo")
-        else:
-            ref_pose_coeff_path = None
-            ref_eyeblink_coeff_path = None
+                pose_styles = [pose_style]
+            if use_ref_video and ref_info == "all":
+                # the reference video drives the pose, there is no style to pick
+                pose_styles = pose_styles[:1]
+                coeff_paths = [ref_video_coeff_path]  # audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            else:
+                from .generate_batch import get_data
 
-        # audio2ceoff
-        if use_ref_video and ref_info == "all":
-            coeff_path = ref_video_coeff_path  # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
-        else:
-            batch = get_data(
-                first_coeff_path,
-                audio_path,
-                self.device,
-                ref_eyeblink_coeff_path=ref_eyeblink_coeff_path,
-                still=still_mode,
-                idlemode=use_idle_mode,
-                length_of_audio=length_of_audio,
-                use_blink=use_blink,
-            )  # longer audio?
-            coeff_path = self.audio_to_coeff.generate(
-                batch, save_dir, pose_style, ref_pose_coeff_path
-            )
+                batch = get_data(
+                    first_coeff_path,
+                    audio_path,
+                    self.device,
+                    ref_eyeblink_coeff_path=ref_eyeblink_coeff_path,
+                    still=still_mode,
+                    idlemode=use_idle_mode,
+                    length_of_audio=length_of_audio,
+                    use_blink=use_blink,
+                )  # longer audio?
+                coeff_paths = audio_to_coeff.generate_styles(
+                    batch,
+                    workspace.path,
+                    pose_styles,
+                    ref_pose_coeff_path,
+                    precision=precision,
+                    silence_db=silence_db,
+                )
 
-        # coeff2video
-        data = get_facerender_data(
-            coeff_path,
-            crop_pic_path,
-            first_coeff_path,
-            audio_path,
-            batch_size,
-            still_mode=still_mode,
-            preprocess=preprocess,
-            size=size,
-            expression_scale=exp_scale,
-        )
-        return_path = self.animate_from_coeff.generate(
-            data,
-            save_dir,
-            pic_path,
-            crop_info,
-            enhancer="gfpgan" if use_enhancer else None,
-            preprocess=preprocess,
-            img_size=size,
-        )
-        video_name = data["video_name"]
-        print(f"The generated video is named {video_name} in {save_dir}")
+            # coeff2video
+            progress("render", 0.4)
+            from .generate_facerender_batch import get_facerender_data
 
-        del self.preprocess_model
-        del self.audio_to_coeff
-        del self.animate_from_coeff
+            os.makedirs(save_dir, exist_ok=True)
+            styles = {}
+
+            def render_progress(index):
+                # rendering takes 0.4 to 0.9 of the job, split between styles
+                def callback(fraction):
+                    if progress_callback is not None:
+                        progress_callback(
+                            "render", 0.4 + 0.5 * (index + fraction) / len(pose_styles)
+                        )
+
+                return callback
+
+            try:
+                for index, (style, coeff_path) in enumerate(
+                    zip(pose_styles, coeff_paths)
+                ):
+                    data = get_facerender_data(
+                        coeff_path,
+                        crop_pic_path,
+                        first_coeff_path,
+                        audio_path,
+                        batch_size,
+                        still_mode=still_mode,
+                        preprocess=preprocess,
+                        size=size,
+                        expression_scale=exp_scale,
+                    )
+                    styles[style] = animate_from_coeff.generate(
+                        data,
+                        save_dir,
+                        pic_path,
+                        crop_info,
+                        enhancer="gfpgan" if use_enhancer else None,
+                        preprocess=preprocess,
+                        img_size=size,
+                        return_artifacts=True,
+                        temp_dir=workspace.path,
+                        segment_frames=segment_frames,
+                        precision=precision,
+                        progress_callback=render_progress(index),
+                    )
+                    video_name = data["video_name"]
+                    print(f"The generated video is named {video_name} in {save_dir}")
+            except BaseException:
+                # no half-written videos are left behind
+                shutil.rmtree(save_dir, ignore_errors=True)
+                raise
+        artifacts = styles[pose_styles[0]]
 
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-
-        import gc
 
-        gc.collect()
+        timings = timer.stop()
+        if progress_callback is not None:
+            progress_callback("done", 1.0)
 
-        return return_path
+        return {
+            "job_id": time_tag,
+            "workspace": save_dir,
+            "video_path": artifacts["final"],
+            "artifacts": artifacts,
+            "styles": styles,
+            "timings": timings,
+        }
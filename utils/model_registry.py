@@ -0,0 +1,185 @@
+import gc
+import threading
+import types
+from collections import OrderedDict
+
+import torch
+
+from .utils.init_path import init_path, preprocess_family
+from .utils.safetensor_helper import release_safetensor_checkpoint
+
+
+def _collect_modules(obj, modules, visited):
+    # nets can sit several attributes deep (CropAndExtract.propress.predictor
+    # holds the facexlib detectors), so follow every attribute, not just the
+    # first levels; visited guards against reference cycles
+    if id(obj) in visited or isinstance(obj, (type, types.ModuleType)):
+        return
+    visited.add(id(obj))
+    if isinstance(obj, torch.nn.Module):
+        modules[id(obj)] = obj
+        return
+    if isinstance(obj, dict):
+        values = obj.values()
+    elif isinstance(obj, (list, tuple, set)):
+        values = obj
+    elif hasattr(obj, "__dict__"):
+        values = vars(obj).values()
+    else:
+        return
+    for value in list(values):
+        _collect_modules(value, modules, visited)
+
+
+def models_nbytes(*objs):
+    """
+    Bytes held by the parameters and buffers of every nn.Module reachable from objs.
+    Tensors shared between modules are only counted once.
+    """
+    modules = {}
+    visited = set()
+    for obj in objs:
+        _collect_modules(obj, modules, visited)
+
+    seen = set()
+    total = 0
+    for module in modules.values():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ModelRegistry:
+    """
+    Keeps warm CropAndExtract / Audio2Coeff / AnimateFromCoeff instances across
+    requests, keyed by (size, checkpoint variant). Preprocess families only
+    differ in the MappingNet head, which is added to the shared renderer the
+    first time a family is requested.
+
+    Entries are evicted least recently used first, either when more than
+    max_models are cached or when their summed weights exceed memory_budget_mb.
+    The entry that was just requested is never evicted.
+    """
+
+    def __init__(
+        self,
+        checkpoint_path,
+        config_path,
+        device,
+        max_models=2,
+        memory_budget_mb=None,
+    ):
+        self.checkpoint_path = checkpoint_path
+        self.config_path = config_path
+        self.device = device
+        self.max_models = max_models
+        self.memory_budget = (
+            None if memory_budget_mb is None else int(memory_budget_mb * 1024 * 1024)
+        )
+
+        self.entries = OrderedDict()
+        # sizes of entries that have been loaded before, used to make room
+        # before loading them again.
+        self.known_nbytes = {}
+        self.lock = threading.RLock()
+
+    def key(self, size, preprocess, old_version=False):
+        paths = init_path(
+            self.checkpoint_path, self.config_path, size, old_version, preprocess
+        )
+        variant = "safetensor" if paths["use_safetensor"] else "pth"
+        return (int(size), variant), paths
+
+    def get(self, size=256, preprocess="crop", old_version=False):
+        """
+        Warm models for size and preprocess. The returned entry carries the
+        `paths` of this request.
+        """
+        with self.lock:
+            key, paths = self.key(size, preprocess, old_version)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                entry = self.entries[key]
+                renderer = entry["animate_from_coeff"]
+                if paths["preprocess_family"] not in renderer.mappings:
+                    print("adding %s mapping net to" % paths["preprocess_family"], key)
+                    renderer.add_mapping(paths)
+                    entry["nbytes"] = models_nbytes(
+                        entry["preprocess_model"],
+                        entry["audio_to_coeff"],
+                        renderer,
+                    )
+                    self.known_nbytes[key] = entry["nbytes"]
+                    self.evict(keep=key)
+                return dict(entry, paths=paths)
+
+            self.evict(reserve=self.known_nbytes.get(key, 0), keep=None, extra=1)
+
+            print("loading models for", key)
+            # the pipeline modules pull in most of the heavy dependencies, they
+            # are only imported once models are actually built
+            from .utils.preprocess import CropAndExtract
+            from .test_audio2coeff import Audio2Coeff
+            from .facerender.animate import AnimateFromCoeff
+
+            entry = {
+                "key": key,
+                "paths": paths,
+                "preprocess_model": CropAndExtract(paths, self.device),
+                "audio_to_coeff": Audio2Coeff(paths, self.device),
+                "animate_from_coeff": AnimateFromCoeff(paths, self.device),
+            }
+            # the mapping nets added later load from .pth, the mapped
+            # checkpoint is not needed once the components are built
+            if paths["use_safetensor"]:
+                release_safetensor_checkpoint(paths["checkpoint"])
+            entry["nbytes"] = models_nbytes(
+                entry["preprocess_model"],
+                entry["audio_to_coeff"],
+                entry["animate_from_coeff"],
+            )
+            self.known_nbytes[key] = entry["nbytes"]
+            self.entries[key] = entry
+
+            self.evict(keep=key)
+            return dict(entry)
+
+    def total_nbytes(self):
+        return sum(entry["nbytes"] for entry in self.entries.values())
+
+    def evict(self, reserve=0, keep=None, extra=0):
+        """
+        Drop least recently used entries until there is room for `extra` more
+        entries and `reserve` more bytes. `keep` is never dropped.
+        """
+        evicted = False
+        while self.entries:
+            over_count = len(self.entries) + extra > self.max_models
+            over_budget = (
+                self.memory_budget is not None
+                and self.total_nbytes() + reserve > self.memory_budget
+            )
+            if not (over_count or over_budget):
+                break
+
+            candidates = [k for k in self.entries if k != keep]
+            if not candidates:
+                break
+            print("evicting models for", candidates[0])
+            del self.entries[candidates[0]]
+            evicted = True
+
+        if evicted:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
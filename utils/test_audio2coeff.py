@@ -5,13 +5,12 @@ from scipy.io import savemat, loadmat
 from yacs.config import CfgNode as CN
 from scipy.signal import savgol_filter
 
-import safetensors
-import safetensors.torch
-
 from .audio2pose_models.audio2pose import Audio2Pose
 from .audio2exp_models.networks import SimpleWrapperV2
 from .audio2exp_models.audio2exp import Audio2Exp
-from .utils.safetensor_helper import load_x_from_safetensor
+from .utils.safetensor_helper import get_safetensor_checkpoint
+from .utils.inference_build import drop_keys, load_needed_state_dict, report_skipped
+from .utils.precision import autocast_dtype, precision_autocast
 
 
 def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
@@ -25,7 +24,7 @@ def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
 
 
 class Audio2Coeff:
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, inference_only=True):
         # load config
         fcfg_pose = open(sadtalker_path["audio2pose_yaml_path"])
         cfg_pose = CN.load_cfg(fcfg_pose)
@@ -34,19 +33,33 @@ class Audio2Coeff:
         cfg_exp = CN.load_cfg(fcfg_exp)
         cfg_exp.freeze()
 
+        if sadtalker_path["use_safetensor"]:
+            checkpoints = get_safetensor_checkpoint(sadtalker_path["checkpoint"])
+
         # load audio2pose_model
-        self.audio2pose_model = Audio2Pose(cfg_pose, None, device=device)
+        self.audio2pose_model = Audio2Pose(
+            cfg_pose, None, device=device, inference_only=inference_only
+        )
         self.audio2pose_model = self.audio2pose_model.to(device)
         self.audio2pose_model.eval()
         for param in self.audio2pose_model.parameters():
             param.requires_grad = False
 
         try:
-            if sadtalker_path["use_safetensor"]:
-                checkpoints = safetensors.torch.load_file(sadtalker_path["checkpoint"])
-                self.audio2pose_model.load_state_dict(
-                    load_x_from_safetensor(checkpoints, "audio2pose")
+            if inference_only:
+                skipped = Audio2Pose.training_only_prefixes
+                if sadtalker_path["use_safetensor"]:
+                    state_dict = checkpoints.load_x("audio2pose", skipped)
+                else:
+                    state_dict = torch.load(
+                        sadtalker_path["audio2pose_checkpoint"],
+                        map_location=torch.device(device),
+                    )["model"]
+                load_needed_state_dict(
+                    self.audio2pose_model, drop_keys(state_dict, skipped)
                 )
+            elif sadtalker_path["use_safetensor"]:
+                self.audio2pose_model.load_state_dict(checkpoints.load_x("audio2pose"))
             else:
                 load_cpk(
                     sadtalker_path["audio2pose_checkpoint"],
@@ -55,6 +68,8 @@ class Audio2Coeff:
                 )
         except:
             raise Exception("Failed in loading audio2pose_checkpoint")
+        if inference_only:
+            report_skipped("audio2pose", Audio2Pose.training_only_nbytes(cfg_pose))
 
         # load audio2exp_model
         netG = SimpleWrapperV2()
@@ -64,8 +79,7 @@ class Audio2Coeff:
         netG.eval()
         try:
             if sadtalker_path["use_safetensor"]:
-                checkpoints = safetensors.torch.load_file(sadtalker_path["checkpoint"])
-                netG.load_state_dict(load_x_from_safetensor(checkpoints, "audio2exp"))
+                netG.load_state_dict(checkpoints.load_x("audio2exp"))
             else:
                 load_cpk(
                     sadtalker_path["audio2exp_checkpoint"], model=netG, device=device
@@ -82,18 +96,63 @@ class Audio2Coeff:
 
         self.device = device
 
-    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff_path=None):
+    def generate(
+        self,
+        batch,
+        coeff_save_dir,
+        pose_style,
+        ref_pose_coeff_path=None,
+        precision="fp32",
+        seed=None,
+        silence_db=None,
+    ):
+        return self.generate_styles(
+            batch,
+            coeff_save_dir,
+            [pose_style],
+            ref_pose_coeff_path,
+            precision=precision,
+            seed=seed,
+            silence_db=silence_db,
+        )[0]
+
+    def generate_styles(
+        self,
+        batch,
+        coeff_save_dir,
+        pose_styles,
+        ref_pose_coeff_path=None,
+        precision="fp32",
+        seed=None,
+        silence_db=None,
+    ):
+        """
+        One coefficient file per pose style in pose_styles, returned in the
+        same order. The expression is predicted once and the CVAE decodes all
+        styles as one batch. With several styles the file names end in
+        _style<id>, so the rendered videos are named apart too.
+
+        Both audio encoders run once per run of identical mel windows, as in
+        idle mode; silence_db (e.g. -60) also merges spans whose mel windows
+        stay at most that loud, trading exactness in pauses for speed.
+        """
+        # both networks run under autocast for bf16/fp16, see utils.precision
+        dtype = autocast_dtype(precision, self.device)
         with torch.no_grad():
             # test
-            results_dict_exp = self.audio2exp_model.test(batch)
-            exp_pred = results_dict_exp["exp_coeff_pred"]  # bs T 64
+            with precision_autocast(dtype, self.device):
+                results_dict_exp = self.audio2exp_model.test(batch, silence_db=silence_db)
+            exp_pred = results_dict_exp["exp_coeff_pred"].float()  # bs T 64
 
             # for class_id in  range(1):
             # class_id = 0#(i+10)%45
             # class_id = random.randint(0,46)                                   #46 styles can be selected
-            batch["class"] = torch.LongTensor([pose_style]).to(self.device)
-            results_dict_pose = self.audio2pose_model.test(batch)
-            pose_pred = results_dict_pose["pose_pred"]  # bs T 6
+            batch["class"] = torch.LongTensor(list(pose_styles)).to(self.device)
+            with precision_autocast(dtype, self.device):
+                results_dict_pose = self.audio2pose_model.test(
+                    batch, seed=seed, silence_db=silence_db
+                )
+            pose_pred = results_dict_pose["pose_pred"].float()  # styles T 6
 
             pose_len = pose_pred.shape[1]
             if pose_len < 13:
@@ -106,26 +165,26 @@ class Audio2Coeff:
                     savgol_filter(np.array(pose_pred.cpu()), 13, 2, axis=1)
                 ).to(self.device)
 
-            coeffs_pred = torch.cat((exp_pred, pose_pred), dim=-1)  # bs T 70
+            exp_pred = exp_pred.expand(pose_pred.shape[0], -1, -1)
+            coeffs_pred = torch.cat((exp_pred, pose_pred), dim=-1)  # styles T 70
 
-            coeffs_pred_numpy = coeffs_pred[0].clone().detach().cpu().numpy()
+            coeff_paths = []
+            for i, pose_style in enumerate(pose_styles):
+                coeffs_pred_numpy = coeffs_pred[i].clone().detach().cpu().numpy()
 
-            if ref_pose_coeff_path is not None:
-                coeffs_pred_numpy = self.using_refpose(
-                    coeffs_pred_numpy, ref_pose_coeff_path
-                )
+                if ref_pose_coeff_path is not None:
+                    coeffs_pred_numpy = self.using_refpose(
+                        coeffs_pred_numpy, ref_pose_coeff_path
+                    )
+
+                name = "%s##%s" % (batch["pic_name"], batch["audio_name"])
+                if len(pose_styles) > 1:
+                    name += "_style%d" % pose_style
+                coeff_path = os.path.join(coeff_save_dir, name + ".mat")
+                savemat(coeff_path, {"coeff_3dmm": coeffs_pred_numpy})
+                coeff_paths.append(coeff_path)
 
-            savemat(
-                os.path.join(
-                    coeff_save_dir,
-                    "%s##%s.mat" % (batch["pic_name"], batch["audio_name"]),
-                ),
-                {"coeff_3dmm": coeffs_pred_numpy},
-            )
-
-            return os.path.join(
-                coeff_save_dir, "%s##%s.mat" % (batch["pic_name"], batch["audio_name"])
-            )
+            return coeff_paths
 
     def using_refpose(self, coeffs_pred_numpy, ref_pose_coeff_path):
         num_frames = coeffs_pred_numpy.shape[0]
@@ -0,0 +1,156 @@
+import torch
+
+
+def module_nbytes(module):
+    return sum(
+        t.numel() * t.element_size()
+        for t in list(module.parameters()) + list(module.buffers())
+    )
+
+
+def meta_nbytes(build_module):
+    """
+    Size of the weights build_module() would allocate, measured on the meta
+    device so nothing is actually allocated. Returns None on torch < 2.0,
+    which has no default-device context manager.
+    """
+    try:
+        with torch.device("meta"):
+            module = build_module()
+    except (AttributeError, TypeError):
+        return None
+    return module_nbytes(module)
+
+
+def drop_keys(state_dict, skipped_prefixes):
+    return {
+        k: v
+        for k, v in state_dict.items()
+        if not any(k.startswith(prefix) for prefix in skipped_prefixes)
+    }
+
+
+def load_needed_state_dict(model, state_dict):
+    """
+    Non-strict load for a model built without its training-only submodules:
+    extra checkpoint entries are ignored, but every weight the model does have
+    must be present.
+    """
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if missing:
+        raise RuntimeError(
+            "Missing keys in state_dict for %s: %s"
+            % (model.__class__.__name__, ", ".join(missing))
+        )
+    return unexpected
+
+
+def report_skipped(name, nbytes):
+    if nbytes is None:
+        print("%s: training-only modules skipped" % name)
+    else:
+        print(
+            "%s: training-only modules skipped, saved %.1f MB"
+            % (name, nbytes / 1024 / 1024)
+        )
+
+
+def fold_spectral_norm(model):
+    """
+    Replaces every spectral_norm hook in model by the plain weight it computes
+    in eval mode (the stored u and v, no power iteration), so the forward pass
+    no longer renormalizes the weight on each call. Needs the checkpoint to be
+    loaded already: the folded modules have no weight_orig/u/v to load into.
+    Returns the number of folded modules.
+    """
+    from torch.nn.utils.spectral_norm import SpectralNorm
+
+    folded = 0
+    for module in model.modules():
+        hooks = module._forward_pre_hooks.values()
+        if any(isinstance(hook, SpectralNorm) for hook in hooks):
+            torch.nn.utils.remove_spectral_norm(module)
+            folded += 1
+    return folded
+
+
+def max_abs_diff(reference, output):
+    """Largest absolute difference between two outputs, tensors or dicts of tensors."""
+    if isinstance(reference, dict):
+        return max(
+            max_abs_diff(reference[k], output[k])
+            for k in reference
+            if torch.is_tensor(reference[k])
+        )
+    return (reference.float() - output.float()).abs().max().item()
+
+
+def convert_sync_batchnorm(model):
+    """
+    Swaps the SynchronizedBatchNorm1d/2d/3d layers of model for the plain
+    torch.nn ones with the same state. In eval mode both compute the same
+    thing, the plain layers just skip the data-parallel bookkeeping.
+    Returns the number of converted layers.
+    """
+    from ..facerender.sync_batchnorm import (
+        SynchronizedBatchNorm1d,
+        SynchronizedBatchNorm2d,
+        SynchronizedBatchNorm3d,
+    )
+
+    plain = {
+        SynchronizedBatchNorm1d: torch.nn.BatchNorm1d,
+        SynchronizedBatchNorm2d: torch.nn.BatchNorm2d,
+        SynchronizedBatchNorm3d: torch.nn.BatchNorm3d,
+    }
+    converted = 0
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if type(child) not in plain:
+                continue
+            norm = plain[type(child)](
+                child.num_features,
+                eps=child.eps,
+                momentum=child.momentum,
+                affine=child.affine,
+            )
+            norm.load_state_dict(child.state_dict())
+            norm.to(child.running_mean.device)
+            norm.train(child.training)
+            setattr(parent, name, norm)
+            converted += 1
+    return converted
+
+
+def fold_batchnorm(model):
+    """
+    Merges eval-mode batch norms into the conv right before them. Only the
+    (conv, norm) attribute pairs a module lists in its `fold_pairs` are
+    touched, the norm is replaced by an identity. Pre-activation blocks
+    (norm -> relu -> conv, e.g. ResBlock3d) cannot be folded and keep their
+    norms. Returns the number of folded pairs.
+    """
+    folded = 0
+    for module in model.modules():
+        for conv_name, norm_name in getattr(module, "fold_pairs", ()):
+            conv = getattr(module, conv_name, None)
+            norm = getattr(module, norm_name, None)
+            is_norm = isinstance(norm, torch.nn.modules.batchnorm._BatchNorm)
+            if not is_norm or norm.training:
+                continue
+            with torch.no_grad():
+                scale = torch.rsqrt(norm.running_var + norm.eps)
+                if norm.affine:
+                    scale = scale * norm.weight
+                shift = -norm.running_mean * scale
+                if norm.affine:
+                    shift = shift + norm.bias
+                if conv.bias is None:
+                    conv.bias = torch.nn.Parameter(
+                        torch.zeros_like(shift), requires_grad=False
+                    )
+                conv.weight.mul_(scale.view((-1,) + (1,) * (conv.weight.dim() - 1)))
+                conv.bias.copy_(conv.bias * scale + shift)
+            setattr(module, norm_name, torch.nn.Identity())
+            folded += 1
+    return folded
@@ -1,6 +1,11 @@
 import os
 import glob
 
+def preprocess_family(preprocess):
+    # 'full' and 'extfull' use mapping_00109 + facerender_still.yaml, every
+    # other mode shares mapping_00229 + facerender.yaml.
+    return 'full' if 'full' in preprocess.lower() else 'crop'
+
 def init_path(checkpoint_dir, config_dir, size=512, old_version=False, preprocess='crop'):
 
     if old_version:
@@ -37,7 +42,8 @@ def init_path(checkpoint_dir, config_dir, size=512, old_version=False, preproces
     sadtalker_paths['audio2exp_yaml_path'] = os.path.join(config_dir, 'auido2exp.yaml')
     sadtalker_paths['use_safetensor'] =  use_safetensor # os.path.join(config_dir, 'auido2exp.yaml')
 
-    if 'full' in preprocess:
+    sadtalker_paths['preprocess_family'] = preprocess_family(preprocess)
+    if sadtalker_paths['preprocess_family'] == 'full':
         sadtalker_paths['mappingnet_checkpoint'] = os.path.join(checkpoint_dir, 'mapping_00109-model.pth.tar')
         sadtalker_paths['facerender_yaml'] = os.path.join(config_dir, 'facerender_still.yaml')
     else:
@@ -0,0 +1,50 @@
+import torch
+from tqdm import tqdm
+
+from ..utils.hparams import hparams as hp
+
+
+def mel_level(db):
+    """
+    The normalized mel value of db, on the scale of audio.melspectrogram
+    (dB after ref_level_db is subtracted, min_level_db is the floor).
+    """
+    scaled = (db - hp.min_level_db) / -hp.min_level_db
+    if hp.symmetric_mels:
+        return 2 * hp.max_abs_value * scaled - hp.max_abs_value
+    return hp.max_abs_value * scaled
+
+
+def mel_runs(mels, silence_db=None):
+    """
+    Runs of consecutive identical mel windows in mels (N, 1, 80, 16).
+    Returns (starts, run_index): the index of the first window of every run
+    and, for every window, the number of its run. With silence_db, windows
+    whose loudest bin is at most silence_db dB count as identical to each
+    other, so a near-silent span is one run, represented by its first window.
+    """
+    flat = mels.reshape(mels.shape[0], -1)
+    same = (flat[1:] == flat[:-1]).all(dim=1)
+    if silence_db is not None:
+        silent = flat.amax(dim=1) <= mel_level(silence_db)
+        same = same | (silent[1:] & silent[:-1])
+    new_run = torch.ones(flat.shape[0], dtype=torch.bool, device=flat.device)
+    new_run[1:] = ~same
+    return new_run.nonzero().squeeze(1), new_run.cumsum(0) - 1
+
+
+def encode_runs(encode, mels, chunk_size, silence_db=None, desc=None):
+    """
+    Embeddings of the mel windows mels (N, 1, 80, 16), computed once per
+    run of mel_runs and broadcast to the run: an idle clip is a single
+    encoder call. encode maps (n, 1, 80, 16) windows to (n, dim), it is
+    called with at most chunk_size windows; desc shows a progress bar.
+    """
+    starts, run_index = mel_runs(mels, silence_db)
+    steps = range(0, starts.shape[0], chunk_size)
+    if desc is not None:
+        steps = tqdm(steps, desc)
+    embedding = torch.cat(
+        [encode(mels[starts[i : i + chunk_size]]) for i in steps], dim=0
+    )
+    return embedding[run_index]
@@ -13,6 +13,7 @@ def paste_pic(
     new_audio_path,
     full_video_path,
     extended_crop=False,
+    temp_dir=None,
 ):
     if not os.path.isfile(pic_path):
         raise ValueError("pic_path must be a valid path to video/image file")
@@ -34,16 +35,6 @@ def paste_pic(
     frame_h = full_img.shape[0]
     frame_w = full_img.shape[1]
 
-    video_stream = cv2.VideoCapture(video_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    crop_frames = []
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
-            video_stream.release()
-            break
-        crop_frames.append(frame)
-
     if len(crop_info) != 3:
         print("you didn't crop the image")
         return
@@ -60,11 +51,24 @@ def paste_pic(
         else:
             oy1, oy2, ox1, ox2 = cly + ly, cly + ry, clx + lx, clx + rx
 
-    tmp_path = str(uuid.uuid4()) + ".mp4"
+    if temp_dir is None:
+        temp_dir = os.path.dirname(os.path.abspath(full_video_path))
+    tmp_path = os.path.join(temp_dir, str(uuid.uuid4()) + ".mp4")
+
+    # one crop frame at a time, read, pasted and written
+    video_stream = cv2.VideoCapture(video_path)
+    fps = video_stream.get(cv2.CAP_PROP_FPS)
+    num_frames = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
     out_tmp = cv2.VideoWriter(
         tmp_path, cv2.VideoWriter_fourcc(*"MP4V"), fps, (frame_w, frame_h)
     )
-    for crop_frame in tqdm(crop_frames, "seamlessClone:"):
+    pbar = tqdm(total=num_frames, desc="seamlessClone:")
+    while 1:
+        # the frame count is only an estimate for some containers, read to the end
+        still_reading, crop_frame = video_stream.read()
+        if not still_reading:
+            break
+        pbar.update(1)
         p = cv2.resize(crop_frame.astype(np.uint8), (ox2 - ox1, oy2 - oy1))
 
         mask = 255 * np.ones(p.shape, p.dtype)
@@ -72,9 +76,11 @@ def paste_pic(
         gen_img = cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
         out_tmp.write(gen_img)
 
+    pbar.close()
+    video_stream.release()
     out_tmp.release()
 
     save_video_with_watermark(
-        tmp_path, new_audio_path, full_video_path, watermark=False
+        tmp_path, new_audio_path, full_video_path, watermark=False, temp_dir=temp_dir
     )
     os.remove(tmp_path)
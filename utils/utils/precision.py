@@ -0,0 +1,48 @@
+import contextlib
+
+import numpy as np
+import torch
+
+PRECISIONS = ("fp32", "bf16", "fp16")
+
+
+def autocast_dtype(precision, device):
+    """
+    The autocast dtype of precision on device, None for fp32. fp16 needs CUDA
+    and bf16 a CPU or a GPU that supports it; otherwise fp32 is used.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(
+            "precision must be one of %s, got %r" % (", ".join(PRECISIONS), precision)
+        )
+    device_type = torch.device(device).type
+    if precision == "fp16" and device_type == "cuda":
+        return torch.float16
+    if precision == "bf16" and (
+        device_type == "cpu"
+        or (device_type == "cuda" and torch.cuda.is_bf16_supported())
+    ):
+        return torch.bfloat16
+    if precision != "fp32":
+        print("%s is not supported on %s, running in fp32" % (precision, device_type))
+    return None
+
+
+def precision_autocast(dtype, device):
+    """
+    Autocast context for an autocast_dtype result, a no-op for None. Enter a
+    fresh one for each region: the softmaxes, grid_sample and keypoint math
+    are kept in fp32 by the modules themselves.
+    """
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+def psnr(reference, frames, peak=255.0):
+    """PSNR in dB of uint8 frames against reference frames of the same shape."""
+    diff = reference.astype(np.float64) - frames.astype(np.float64)
+    mse = np.mean(diff**2)
+    if mse == 0:
+        return float("inf")
+    return 10 * np.log10(peak**2 / mse)
@@ -4,8 +4,6 @@ from tqdm import tqdm
 from PIL import Image
 
 # 3dmm extraction
-import safetensors
-import safetensors.torch
 from ..face3d.util.preprocess import align_img
 from ..face3d.util.load_mats import load_lm3d
 from ..face3d.models import networks
@@ -16,7 +14,7 @@ from ..utils.croper import Preprocesser
 
 import warnings
 
-from ..utils.safetensor_helper import load_x_from_safetensor
+from ..utils.safetensor_helper import get_safetensor_checkpoint
 
 warnings.filterwarnings("ignore")
 
@@ -53,10 +51,8 @@ class CropAndExtract:
         ).to(device)
 
         if sadtalker_path["use_safetensor"]:
-            checkpoint = safetensors.torch.load_file(sadtalker_path["checkpoint"])
-            self.net_recon.load_state_dict(
-                load_x_from_safetensor(checkpoint, "face_3drecon")
-            )
+            checkpoint = get_safetensor_checkpoint(sadtalker_path["checkpoint"])
+            self.net_recon.load_state_dict(checkpoint.load_x("face_3drecon"))
         else:
             checkpoint = torch.load(
                 sadtalker_path["path_of_net_recon_model"],
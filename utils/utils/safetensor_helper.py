@@ -1,3 +1,7 @@
+import os
+import threading
+
+from safetensors import safe_open
 
 
 def load_x_from_safetensor(checkpoint, key):
@@ -5,4 +9,60 @@ def load_x_from_safetensor(checkpoint, key):
     for k,v in checkpoint.items():
         if key in k:
             x_generator[k.replace(key+'.', '')] = v
-    return x_generator
\ No newline at end of file
+    return x_generator
+
+
+class SafetensorCheckpoint:
+    """
+    Memory-maps a `.safetensors` file once and only reads the tensors of the
+    requested component ('face_3drecon', 'audio2pose', 'audio2exp',
+    'generator', 'kp_extractor', ...). get_tensor copies every tensor out of
+    the mapping, the models own their weights and do not share pages.
+    """
+
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.handle = safe_open(checkpoint_path, framework="pt", device="cpu")
+        self.keys = list(self.handle.keys())
+
+    def load_x(self, key, skipped_prefixes=()):
+        """
+        Tensors of component `key` with the prefix stripped. Entries whose
+        stripped name starts with one of skipped_prefixes are never read.
+        """
+        x_generator = {}
+        for k in self.keys:
+            if key in k:
+                name = k.replace(key+'.', '')
+                if name.startswith(tuple(skipped_prefixes)):
+                    continue
+                x_generator[name] = self.handle.get_tensor(k)
+        return x_generator
+
+
+_checkpoints = {}
+_checkpoints_lock = threading.Lock()
+
+
+def get_safetensor_checkpoint(checkpoint_path):
+    """
+    Shared SafetensorCheckpoint for checkpoint_path, so the pipeline components
+    built from one checkpoint open and index the file once. Release it with
+    release_safetensor_checkpoint once they are built, nothing reads it later.
+    """
+    checkpoint_path = os.path.abspath(checkpoint_path)
+    with _checkpoints_lock:
+        if checkpoint_path not in _checkpoints:
+            _checkpoints[checkpoint_path] = SafetensorCheckpoint(checkpoint_path)
+        return _checkpoints[checkpoint_path]
+
+
+def release_safetensor_checkpoint(checkpoint_path):
+    """Drops the shared handle of checkpoint_path, closing its mapping."""
+    with _checkpoints_lock:
+        _checkpoints.pop(os.path.abspath(checkpoint_path), None)
+
+
+def release_safetensor_checkpoints():
+    with _checkpoints_lock:
+        _checkpoints.clear()
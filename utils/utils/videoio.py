@@ -1,4 +1,5 @@
 import shutil
+import subprocess
 import uuid
 
 import os
@@ -17,8 +18,26 @@ def load_video_to_cv2(input_path):
         full_frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
     return full_frames
 
-def save_video_with_watermark(video, audio, save_path, watermark=False):
-    temp_file = str(uuid.uuid4())+'.mp4'
+def concat_videos(video_paths, save_path, temp_dir=None):
+    # stream copy, the segments must share codec and encoding settings;
+    # raises subprocess.CalledProcessError when ffmpeg fails
+    if temp_dir is None:
+        temp_dir = os.path.dirname(os.path.abspath(save_path))
+    list_file = os.path.join(temp_dir, str(uuid.uuid4())+'.txt')
+    with open(list_file, 'w') as f:
+        for path in video_paths:
+            f.write("file '%s'\n" % os.path.abspath(path).replace("'", "'\\''"))
+    try:
+        subprocess.run(['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-f', 'concat',
+                        '-safe', '0', '-i', list_file, '-c', 'copy', save_path], check=True)
+    finally:
+        os.remove(list_file)
+
+def save_video_with_watermark(video, audio, save_path, watermark=False, temp_dir=None):
+    # the intermediate file goes next to the output unless a workspace is given
+    if temp_dir is None:
+        temp_dir = os.path.dirname(os.path.abspath(save_path))
+    temp_file = os.path.join(temp_dir, str(uuid.uuid4())+'.mp4')
     cmd = r'ffmpeg -y -hide_banner -loglevel error -i "%s" -i "%s" -vcodec copy "%s"' % (video, audio, temp_file)
     os.system(cmd)
 
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+
+TMPFS_ROOT = "/dev/shm"
+
+
+class JobWorkspace:
+    """
+    Scratch directory of one job, every intermediate file of the pipeline is
+    written inside it so parallel jobs never collide.
+
+    It is created under `root`, or under /dev/shm when use_tmpfs is set and
+    available, or else under the system temp dir. `cleanup` removes it; used as
+    a context manager it is removed on success, failure and cancellation alike.
+    """
+
+    def __init__(self, root=None, use_tmpfs=False, prefix="sadtalker_"):
+        if root is None and use_tmpfs:
+            if os.path.isdir(TMPFS_ROOT):
+                root = TMPFS_ROOT
+            else:
+                print("%s is not available, using the system temp dir" % TMPFS_ROOT)
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+
+    def subdir(self, *names):
+        path = os.path.join(self.path, *names)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
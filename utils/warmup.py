@@ -0,0 +1,95 @@
+import os
+import statistics
+
+import cv2
+import numpy as np
+from pydub import AudioSegment
+
+from .utils.workspace import JobWorkspace
+
+
+def make_synthetic_inputs(save_dir, size=256, seconds=1):
+    """
+    Writes a drawn face-sized image and `seconds` of silence to save_dir and
+    returns their paths. No face is detected in the image, `resize` preprocess
+    falls back to the mean landmarks so every stage still runs.
+    """
+    image = np.full((size, size, 3), 200, dtype=np.uint8)
+    center = (size // 2, size // 2)
+    # skin, eyes and mouth
+    cv2.ellipse(
+        image, center, (size // 3, size * 2 // 5), 0, 0, 360, (150, 170, 210), -1
+    )
+    for dx in [-size // 8, size // 8]:
+        eye = (center[0] + dx, center[1] - size // 10)
+        cv2.circle(image, eye, size // 20, (40, 40, 40), -1)
+    mouth = (center[0], center[1] + size // 6)
+    cv2.ellipse(image, mouth, (size // 8, size // 24), 0, 0, 360, (60, 60, 150), -1)
+    image_path = os.path.join(save_dir, "warmup.png")
+    cv2.imwrite(image_path, image)
+
+    audio_path = os.path.join(save_dir, "warmup.wav")
+    AudioSegment.silent(duration=1000 * seconds, frame_rate=16000).export(
+        audio_path, format="wav"
+    )
+    return image_path, audio_path
+
+
+def warm_up(
+    sad_talker,
+    size=256,
+    preprocess="resize",
+    min_runs=3,
+    max_runs=6,
+    tolerance=0.2,
+):
+    """
+    Runs a tiny synthetic job through every stage of sad_talker until latency
+    is steady: at least min_runs runs, and the last total within `tolerance`
+    (relative) of the median of the warm runs. The first run pays the lazy
+    costs (mel basis, kernel selection, detector init) and is reported as cold.
+
+    Returns a dict with
+        cold   -- per-stage seconds of the first run
+        warm   -- per-stage median seconds of the following runs
+        runs   -- number of runs
+        steady -- whether latency settled within max_runs
+    """
+    runs = []
+    steady = False
+    with JobWorkspace(prefix="warmup_") as workspace:
+        image_path, audio_path = make_synthetic_inputs(workspace.path, size=size)
+        result_dir = workspace.subdir("results")
+        while len(runs) < max_runs:
+            result = sad_talker.test(
+                image_path,
+                audio_path,
+                preprocess=preprocess,
+                size=size,
+                result_dir=result_dir,
+            )
+            runs.append(result["timings"])
+
+            warm_totals = [timings["total"] for timings in runs[1:]]
+            if len(runs) >= min_runs and len(warm_totals) >= 2:
+                p50 = statistics.median(warm_totals)
+                if abs(warm_totals[-1] - p50) <= tolerance * p50:
+                    steady = True
+                    break
+
+    warm_runs = runs[1:] or runs
+    report = {
+        "cold": runs[0],
+        "warm": {
+            stage: round(statistics.median(timings[stage] for timings in warm_runs), 3)
+            for stage in runs[0]
+        },
+        "runs": len(runs),
+        "steady": steady,
+    }
+    for stage in report["cold"]:
+        print(
+            "warm-up %-12s cold %7.3fs  warm %7.3fs"
+            % (stage, report["cold"][stage], report["warm"][stage])
+        )
+    return report